@@ -0,0 +1,48 @@
+import os
+
+import encrypt_password
+
+
+#contenuti cifrati dei file, un oggetto per file nella cartella dei contenuti
+
+
+class BlobStore:
+    """Directory of encrypted file contents, one object per file version.
+
+    The metadata only holds the id of each object, so mounting reads no
+    contents at all: the index of an object is read the first time its file
+    is accessed, and each chunk record when its chunk is.
+    Objects are never rewritten in place, a modified file gets a new object
+    and the old one is removed by sweep() once no base image refers to it.
+    That way a crash during a checkpoint leaves the previous base image and
+    every object it refers to untouched.
+    """
+
+    def __init__(self, mountpoint, keystore_dir=encrypt_password.KEYSTORE_DIR):
+        self.directory = os.path.join(keystore_dir, str(mountpoint)[0] + "contents")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, blob_id):
+        """File holding an object, records are read from it one at a time"""
+        return os.path.join(self.directory, blob_id)
+
+    def put(self, blob):
+        """Store `blob` as a new object, returns its id"""
+        blob_id = os.urandom(16).hex()
+        tmp = self.path(blob_id + ".tmp")
+        with open(tmp, "wb") as file:
+            file.write(blob)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path(blob_id))
+        return blob_id
+
+    def get(self, blob_id):
+        with open(self.path(blob_id), "rb") as file:
+            return file.read()
+
+    def sweep(self, keep):
+        """Remove every object whose id is not in `keep`, and leftovers of interrupted puts"""
+        for name in os.listdir(self.directory):
+            if name not in keep:
+                os.remove(self.path(name))
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+
+#budget di memoria per i contenuti dei file, i meno usati tornano cifrati su disco
+
+
+class ContentCache:
+    """LRU accounting of the memory held by the contents of files.
+
+    operazioni reports every data access with access(), the cache keeps the
+    files in least recently used order together with their resident size as
+    of their last access. While the total is over `budget` bytes, victims()
+    hands out files to evict, oldest first. Evicting is left to operazioni,
+    which knows the locks and when a file can go back to encrypted storage.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._sizes = OrderedDict()
+        self.resident = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def access(self, file_obj, missed):
+        """`file_obj` was just accessed, `missed` when its contents had to be loaded"""
+        with self._lock:
+            if missed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.keep(file_obj)
+
+    def keep(self, file_obj):
+        """Make `file_obj` the most recently used, with its current resident size"""
+        size = file_obj.data.resident()
+        with self._lock:
+            self.resident += size - self._sizes.pop(file_obj, 0)
+            self._sizes[file_obj] = size
+
+    def discard(self, file_obj):
+        with self._lock:
+            self.resident -= self._sizes.pop(file_obj, 0)
+
+    @property
+    def over_budget(self):
+        return self.resident > self.budget
+
+    def victims(self):
+        """Yield the least recently used files while over budget, each one leaves the cache.
+
+        Files that cannot be evicted yet go back with keep() once done.
+        """
+        while True:
+            with self._lock:
+                if self.resident <= self.budget or not self._sizes:
+                    return
+                file_obj, size = self._sizes.popitem(last=False)
+                self.resident -= size
+            yield file_obj
+
+    def evicted(self):
+        with self._lock:
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "budget": self.budget,
+                "resident": self.resident,
+                "files": len(self._sizes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+            }
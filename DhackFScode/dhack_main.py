@@ -1,12 +1,19 @@
 import argparse
+import logging
 from pathlib import Path
 import win32api
 
 from winfspy.plumbing.win32_filetime import filetime_now
 
+import blobs_fs
+import encrypt_password
+import extents_fs
 import file_sys
+import journal_fs
+import metrics_fs
 import operazioni_fs
 import persistence
+import trace_fs
 
 def free_disk(mountpoint):
     # Get memory partitions
@@ -26,12 +33,13 @@ def free_disk(mountpoint):
 
 #main e creazione del file system
 
-def create_FS (mountpoint, operations, persistent):      
+def create_FS (mountpoint, operations, persistent, threads=0):      
 
     vfs=file_sys.VFileSys(
         str(mountpoint),
         operations,
         persistent,
+        dispatcher_threads=threads,
         sector_size=512,
         sectors_per_allocation_unit=1,
         volume_creation_time=filetime_now(),
@@ -50,19 +58,55 @@ def create_FS (mountpoint, operations, persistent):
 
 #nel main il file system viene avviato e stoppato   
 
-def main(mountpoint, label, persistent):  
+def main(mountpoint, label, persistent, threads=0, metrics_file=None, metrics_interval=10.0,
+         keystore_dir=encrypt_password.KEYSTORE_DIR, cipher_workers=None, checkpoint_interval=300.0,
+         checkpoint_mb=64, journal_sync=False, memory_budget_mb=None, dedup=False, compression=None,
+         compression_level=None, trace_file=None):  
     #verifica se la partizione è libera, altrimenti ne viene scelta un'altra
     mountpoint = free_disk(mountpoint)
     mountpoint = Path(mountpoint)
     
-    metadata_tree = persistence.create_metadata_tree(persistent, mountpoint) 
-    operations = operazioni_fs.operazioni(label, mountpoint, metadata_tree, persistent)
+    #crea chiave e password di una partizione nuova, o verifica la password, prima di caricare la chiave
+    metadata_tree, base_segment = persistence.create_metadata_tree(persistent, mountpoint, keystore_dir)
+    keys = None
+    blobs = None
+    if persistent:
+        keys = encrypt_password.KeyManager(mountpoint, keystore_dir, compression, compression_level).load()
+        blobs = blobs_fs.BlobStore(mountpoint, keystore_dir)
+    extents_fs.set_dedup(dedup)
+    memory_budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb is not None else None
+    operations = operazioni_fs.operazioni(label, mountpoint, metadata_tree, persistent, keys=keys, blobs=blobs,
+                                          memory_budget=memory_budget)
+    #l'albero letto serve solo a costruire gli oggetti, non resta in memoria durante il mount
+    del metadata_tree
+    operations.cipher_workers = cipher_workers
+    if trace_file:
+        operations.trace = trace_fs.TraceWriter(trace_file)
+    #replay del journal lasciato da un crash, poi checkpoint periodici in background
+    checkpointer = None
+    if persistent:
+        journal = persistence.open_journal(operations, mountpoint, base_segment, keystore_dir, journal_sync)
+        checkpointer = journal_fs.Checkpointer(
+            journal,
+            lambda: persistence.checkpoint(operations, mountpoint, keystore_dir),
+            checkpoint_interval,
+            checkpoint_mb * 1024 * 1024,
+        )
+        #i file modificati vanno salvati prima di poter uscire dal budget di memoria
+        operations.writeback = checkpointer.request
 
 
-    vfs=create_FS(mountpoint, operations, persistent)
+    vfs=create_FS(mountpoint, operations, persistent, threads)
      
     vfs.start()                                                                    
     print("VirtualFS started.")
+    if checkpointer:
+        checkpointer.start()
+    #dump periodico delle metriche
+    dumper = None
+    if metrics_file:
+        dumper = metrics_fs.MetricsDumper(operations.metrics, metrics_file, metrics_interval)
+        dumper.start()
     #read-only mode
     accessmode=input("Read-only mode? [Y/N] ")                                                
     if accessmode=="Y":
@@ -75,9 +119,20 @@ def main(mountpoint, label, persistent):
     quit=input("Want to quit? [Y/N] ")
     if quit=="Y":
         vfs.stop()
+        if dumper:
+            dumper.stop()
+        if checkpointer:
+            checkpointer.stop()
         if persistent:
-            persistence.store_metadata(operations, mountpoint)
+            persistence.store_metadata(operations, mountpoint, keystore_dir)
+        if operations.trace is not None:
+            operations.trace.close()
         print("VirtualFS stopped")
+        print(operations.metrics.report())
+        if operations.cache is not None:
+            print(operations.cache.stats())
+        if dedup:
+            print(operations.dedup_stats())
 
 #dalla linea di comando viene letto il mountpoint, etichetta col nome del fs di default o stabilita dall'utente e 
 # modalità persistent o non-persistent
@@ -86,8 +141,41 @@ if __name__ == "__main__":
     parser.add_argument("mountpoint")
     parser.add_argument("-l", "--label", type=str, default="Dhackfs")
     parser.add_argument("-p", "--persistent", type=bool, default=True)
+    parser.add_argument("-t", "--threads", type=int, default=0,
+                        help="dispatcher threads, 0 lets WinFsp choose")
+    parser.add_argument("--log-level", type=str, default="WARNING",
+                        help="INFO logs every operation")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="log only 1 operation in N")
+    parser.add_argument("--metrics-file", type=str, default=None,
+                        help="periodically dump operation metrics as JSON to this file")
+    parser.add_argument("--metrics-interval", type=float, default=10.0)
+    parser.add_argument("-k", "--keystore", type=str, default=encrypt_password.KEYSTORE_DIR,
+                        help="directory holding keys and metadata")
+    parser.add_argument("--cipher-workers", type=int, default=None,
+                        help="threads encrypting contents on quit, one per core by default")
+    parser.add_argument("--checkpoint-interval", type=float, default=300.0,
+                        help="seconds between checkpoints of the journal")
+    parser.add_argument("--checkpoint-mb", type=int, default=64,
+                        help="checkpoint as soon as the journal grows past this size")
+    parser.add_argument("--journal-sync", action="store_true",
+                        help="fsync every journal record, survives a host crash but slows every write")
+    parser.add_argument("--memory-budget-mb", type=int, default=None,
+                        help="keep at most this much file contents in memory, unlimited by default")
+    parser.add_argument("--dedup", action="store_true",
+                        help="share identical 64 KiB chunks between files in memory")
+    parser.add_argument("--compress", choices=["zlib", "lzma"], default=None,
+                        help="compress file contents before encrypting them")
+    parser.add_argument("--compress-level", type=int, default=None,
+                        help="zlib level -1..9 or lzma preset 0..9, the codec default if omitted")
+    parser.add_argument("--trace-file", type=str, default=None,
+                        help="record every operation to this file, without contents but with file names in clear")
     args = parser.parse_args()
-    main(args.mountpoint, args.label, args.persistent)
+    logging.basicConfig(level=args.log_level.upper())
+    operazioni_fs.set_log_sampling(args.log_sample)
+    main(args.mountpoint, args.label, args.persistent, args.threads, args.metrics_file, args.metrics_interval,
+         args.keystore, args.cipher_workers, args.checkpoint_interval, args.checkpoint_mb, args.journal_sync,
+         args.memory_budget_mb, args.dedup, args.compress, args.compress_level, args.trace_file)
 
 
 
@@ -1,15 +1,103 @@
+import os
 import string
+import threading
 import bcrypt
 import base64
+import hashlib
+import lzma
 import pickle
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
 
 import random
 
 
+# directory holding pw.txt, mpinfo.txt and the metadata of each mountpoint
+KEYSTORE_DIR = "C://dhckfs"
+
+# Chunked format (version 3) of the encrypted contents of a file:
+#   header  magic, blob id, chunk size, plaintext length
+#   index   for every chunk: u32 record length (0 for a hole) and the nonce
+#           of its record (zeros for a hole)
+#   trailer nonce + AES-GCM(b"") with the blob id, length, chunk count and
+#           the SHA-256 of the index as AAD, sealed with a fresh nonce by
+#           every pack. It binds each record and hole to its place: a record
+#           swapped for a hole, or for an older record of the same chunk,
+#           no longer matches its nonce in the index
+#   records the records of the chunks in order, nonce + AES-GCM(codec byte +
+#           chunk, see _compress) with the blob id, chunk size and index as
+#           AAD. Records sealed before compression existed hold the bare
+#           chunk and use a different AAD tag.
+# Version 2 interleaves u32 lengths and records, and its trailer only covers
+# the length and chunk count: it is still read, and written as version 3 the
+# next time the file is stored. Contents without a magic are whole-file
+# Fernet tokens (version 1).
+CHUNKED_MAGIC = b"DHK\x03"
+_CHUNKED_V2_MAGIC = b"DHK\x02"
+_HEADER = struct.Struct("<4s16sIQ")
+_RECORD_LEN = struct.Struct("<I")
+_CHUNK_AAD = struct.Struct("<c16sIQ")
+_TRAILER_V2_AAD = struct.Struct("<c16sQQ")
+_NONCE_SIZE = 12
+_INDEX_ENTRY = struct.Struct(f"<I{_NONCE_SIZE}s")
+_TRAILER_AAD = struct.Struct("<c16sQQ32s")
+# nonce + the GCM tag of an empty plaintext
+_TRAILER_SIZE = _NONCE_SIZE + 16
+_NO_NONCE = bytes(_NONCE_SIZE)
+
+# codec byte of a chunk record
+_RAW, _ZLIB, _LZMA = 0, 1, 2
+_CODECS = {"zlib": _ZLIB, "lzma": _LZMA}
+
+# zlib levels and lzma presets each codec accepts
+_LEVELS = {_ZLIB: range(-1, 10), _LZMA: range(0, 10)}
+
+# compression is only attempted on chunks whose first _PROBE_SIZE bytes
+# shrink below _PROBE_RATIO with the fastest zlib level
+_PROBE_SIZE = 4096
+_PROBE_RATIO = 0.9
+
+
+def _compress(data, codec, level):
+    if codec is not None:
+        sample = data[:_PROBE_SIZE]
+        if len(zlib.compress(sample, 1)) < len(sample) * _PROBE_RATIO:
+            if codec == _ZLIB:
+                packed = zlib.compress(data, -1 if level is None else level)
+            else:
+                packed = lzma.compress(data, preset=6 if level is None else level)
+            if len(packed) < len(data):
+                return bytes((codec,)) + packed
+    return bytes((_RAW,)) + data
+
+
+def _decompress(plain, chunk_size):
+    codec = plain[0]
+    if codec == _RAW:
+        return plain[1:]
+    # bounded by the chunk size, whatever the record claims
+    packed = memoryview(plain)[1:]
+    if codec == _ZLIB:
+        return zlib.decompressobj().decompress(packed, chunk_size)
+    if codec == _LZMA:
+        return lzma.LZMADecompressor().decompress(packed, chunk_size)
+    raise ValueError(f"unknown codec {codec}")
+
+
+def is_chunked(encrypted_data):
+    return encrypted_data[:len(CHUNKED_MAGIC)] in (CHUNKED_MAGIC, _CHUNKED_V2_MAGIC)
+
+
 def generate_random_string(length):
     characters = string.ascii_letters + string.digits
     random_string = ''.join(random.choice(characters) for _ in range(length))
@@ -32,16 +120,267 @@ def generate_key(password, salt):
 
     return key
 
+@lru_cache(maxsize=8)
+def _cipher_for(key):
+    return Fernet(key)
+
 def encrypt_data(data, key):
-    cipher_suite = Fernet(key)
+    cipher_suite = _cipher_for(key)
     encrypted_data = cipher_suite.encrypt(bytes(data))
     return encrypted_data
 
 def decrypt_data(encrypted_data, key):
-    cipher_suite = Fernet(key)
+    cipher_suite = _cipher_for(key)
     decrypted_data = cipher_suite.decrypt(encrypted_data)
     return decrypted_data
 
+
+class FileRecord:
+    """Chunk record left in a stored object, read from it when it is needed.
+
+    Stands for the bytes of the record in what unpack_file() returns. Its
+    size and nonce come from the index, authenticated by the trailer, and
+    the record read back must match them.
+    """
+
+    __slots__ = ("path", "offset", "size", "nonce")
+
+    def __init__(self, path, offset, size, nonce):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.nonce = nonce
+
+    def __len__(self):
+        return self.size
+
+    def read(self, file=None):
+        """The record, from `file` when the object is already open"""
+        if file is None:
+            with open(self.path, "rb") as file:
+                return self.read(file)
+        file.seek(self.offset)
+        record = file.read(self.size)
+        if len(record) != self.size or record[:_NONCE_SIZE] != self.nonce:
+            raise ValueError("chunk record does not match the index")
+        return record
+
+
+class KeyManager:
+    """Key and cipher of one mountpoint, read from the key store once per mount"""
+
+    def __init__(self, mountpoint, keystore_dir=KEYSTORE_DIR, compression=None, compression_level=None):
+        self.mountpoint = mountpoint
+        self.keystore_dir = keystore_dir
+        # "zlib" or "lzma" to compress chunks before encrypting them
+        if compression is not None and compression not in _CODECS:
+            raise ValueError(f"unknown compression {compression!r}")
+        self.compression = _CODECS.get(compression)
+        # rejected here rather than by every pack of the mount
+        if compression is not None and compression_level is not None \
+                and compression_level not in _LEVELS[self.compression]:
+            raise ValueError(f"invalid {compression} compression level {compression_level!r}")
+        self.compression_level = compression_level
+        self._key = None
+        self._cipher = None
+        self._chunk_cipher = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._cipher is None:
+                with open(os.path.join(self.keystore_dir, "pw.txt"), 'rb') as file:
+                    access_info = pickle.load(file)
+                try:
+                    key = access_info[self.mountpoint]["key"]
+                except KeyError:
+                    raise ValueError(f"No key stored for mountpoint {self.mountpoint}")
+                # Fernet rejects malformed keys here rather than on first use
+                self._cipher = Fernet(key)
+                self._key = key
+        return self
+
+    @property
+    def cipher(self):
+        if self._cipher is None:
+            self.load()
+        return self._cipher
+
+    @property
+    def chunk_cipher(self):
+        if self._chunk_cipher is None:
+            # separate AES-GCM key derived from the Fernet key of the volume
+            self.load()
+            key = base64.urlsafe_b64decode(self._key)
+            derived = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                           info=b"dhackfs chunked contents v2").derive(key)
+            self._chunk_cipher = AESGCM(derived)
+        return self._chunk_cipher
+
+    def encrypt(self, data):
+        return self.cipher.encrypt(bytes(data))
+
+    def decrypt(self, encrypted_data):
+        return self.cipher.decrypt(encrypted_data)
+
+    def seal_record(self, data, aad):
+        """AES-GCM encrypt `data` bound to `aad`, as nonce + ciphertext"""
+        nonce = os.urandom(_NONCE_SIZE)
+        return nonce + self.chunk_cipher.encrypt(nonce, data, aad)
+
+    def unseal_record(self, record, aad):
+        return self.chunk_cipher.decrypt(record[:_NONCE_SIZE], record[_NONCE_SIZE:], aad)
+
+    def seal_chunk(self, sealed_id, chunk_size, index, data):
+        data = _compress(data, self.compression, self.compression_level)
+        return self.seal_record(data, _CHUNK_AAD.pack(b"Z", sealed_id, chunk_size, index))
+
+    def unseal_chunk(self, sealed_id, chunk_size, index, record):
+        if isinstance(record, FileRecord):
+            record = record.read()
+        try:
+            plain = self.unseal_record(record, _CHUNK_AAD.pack(b"Z", sealed_id, chunk_size, index))
+        except InvalidTag:
+            # sealed before records carried a codec byte
+            return self.unseal_record(record, _CHUNK_AAD.pack(b"C", sealed_id, chunk_size, index))
+        return _decompress(plain, chunk_size)
+
+    def pack(self, extents, length):
+        """Encrypt the first `length` bytes of `extents` in the chunked format.
+
+        Chunks that were not modified since they were loaded or last packed
+        keep their existing record, only dirty chunks are encrypted.
+        """
+        if extents.sealed_id is None:
+            extents.sealed_id = os.urandom(16)
+        sealed_id, chunk_size = extents.sealed_id, extents.chunk_size
+        index = []
+        records = []
+        seal = lambda index, data: self.seal_chunk(sealed_id, chunk_size, index, data)
+        # objects the unmodified records are copied from, each opened once
+        sources = {}
+        try:
+            for record in extents.sealed_records(length, seal):
+                if record is None:
+                    index.append(_INDEX_ENTRY.pack(0, _NO_NONCE))
+                    continue
+                if isinstance(record, FileRecord):
+                    source = sources.get(record.path)
+                    if source is None:
+                        source = sources[record.path] = open(record.path, "rb")
+                    record = record.read(source)
+                index.append(_INDEX_ENTRY.pack(len(record), bytes(record[:_NONCE_SIZE])))
+                records.append(record)
+        finally:
+            for source in sources.values():
+                source.close()
+        count = len(index)
+        index = b"".join(index)
+        trailer = self.seal_record(b"", _TRAILER_AAD.pack(b"I", sealed_id, length, count,
+                                                           hashlib.sha256(index).digest()))
+        return b"".join([_HEADER.pack(CHUNKED_MAGIC, sealed_id, chunk_size, length), index, trailer, *records])
+
+    def pack_many(self, items, workers=None, max_in_flight=None):
+        """pack() every (extents, length) of `items`, encrypting on `workers` threads.
+
+        Dirty chunks of all files go through a thread pool first, with at most
+        `max_in_flight` chunks queued, then each file is framed in order. The
+        output lists the same files and chunks as calling pack() one by one,
+        only the random nonces differ from run to run.
+        """
+        items = list(items)
+        workers = workers or os.cpu_count() or 1
+        if workers > 1:
+            max_in_flight = max_in_flight or 4 * workers
+            with ThreadPoolExecutor(workers, thread_name_prefix="seal") as pool:
+                pending = deque()
+                for extents, length in items:
+                    if extents.sealed_id is None:
+                        extents.sealed_id = os.urandom(16)
+                    for index, data in extents.dirty_chunks(length):
+                        future = pool.submit(self.seal_chunk, extents.sealed_id, extents.chunk_size, index, data)
+                        pending.append((extents, index, future))
+                        if len(pending) >= max_in_flight:
+                            done_extents, done_index, done = pending.popleft()
+                            done_extents.set_record(done_index, done.result())
+                for done_extents, done_index, done in pending:
+                    done_extents.set_record(done_index, done.result())
+        return [self.pack(extents, length) for extents, length in items]
+
+    def unpack(self, encrypted_data):
+        """Split chunked contents into (sealed_id, chunk_size, length, {index: record}).
+
+        Only the trailer is decrypted, chunks are left for unseal_chunk.
+        """
+        view = memoryview(encrypted_data)
+        magic, sealed_id, chunk_size, length = _HEADER.unpack_from(view)
+        if magic == _CHUNKED_V2_MAGIC:
+            return self._unpack_v2(view)
+        if magic != CHUNKED_MAGIC:
+            raise ValueError("not in the chunked format")
+        count = (length + chunk_size - 1) // chunk_size
+        pos = _HEADER.size + count * _INDEX_ENTRY.size
+        index = view[_HEADER.size : pos]
+        self._check_index(sealed_id, length, count, index, view[pos : pos + _TRAILER_SIZE])
+        pos += _TRAILER_SIZE
+        records = {}
+        for chunk, (size, nonce) in enumerate(_INDEX_ENTRY.iter_unpack(index)):
+            if size:
+                record = view[pos : pos + size]
+                if len(record) != size or record[:_NONCE_SIZE] != nonce:
+                    raise ValueError("chunk record does not match the index")
+                records[chunk] = record
+                pos += size
+        if pos != len(view):
+            raise ValueError("trailing data after the chunk records")
+        return sealed_id, chunk_size, length, records
+
+    def unpack_file(self, path):
+        """unpack() the object stored at `path`, reading only its header, index and trailer.
+
+        The records are FileRecord, each read from the object when its chunk
+        is first decrypted. Objects in the version 2 format are read whole.
+        """
+        with open(path, "rb") as file:
+            header = file.read(_HEADER.size)
+            magic, sealed_id, chunk_size, length = _HEADER.unpack(header)
+            if magic != CHUNKED_MAGIC:
+                return self.unpack(header + file.read())
+            count = (length + chunk_size - 1) // chunk_size
+            index = file.read(count * _INDEX_ENTRY.size)
+            trailer = file.read(_TRAILER_SIZE)
+            size = os.fstat(file.fileno()).st_size
+        if len(index) != count * _INDEX_ENTRY.size:
+            raise ValueError("torn chunk index")
+        self._check_index(sealed_id, length, count, index, trailer)
+        pos = _HEADER.size + len(index) + _TRAILER_SIZE
+        records = {}
+        for chunk, (record_size, nonce) in enumerate(_INDEX_ENTRY.iter_unpack(index)):
+            if record_size:
+                records[chunk] = FileRecord(path, pos, record_size, nonce)
+                pos += record_size
+        if pos != size:
+            raise ValueError("chunk records do not match the size of the object")
+        return sealed_id, chunk_size, length, records
+
+    def _check_index(self, sealed_id, length, count, index, trailer):
+        self.unseal_record(trailer, _TRAILER_AAD.pack(b"I", sealed_id, length, count, hashlib.sha256(index).digest()))
+
+    def _unpack_v2(self, view):
+        _, sealed_id, chunk_size, length = _HEADER.unpack_from(view)
+        pos = _HEADER.size
+        records = {}
+        count = (length + chunk_size - 1) // chunk_size
+        for index in range(count):
+            (size,) = _RECORD_LEN.unpack_from(view, pos)
+            pos += _RECORD_LEN.size
+            if size:
+                records[index] = view[pos : pos + size]
+                pos += size
+        self.unseal_record(view[pos:], _TRAILER_V2_AAD.pack(b"T", sealed_id, length, count))
+        return sealed_id, chunk_size, length, records
+
+
 def is_strong_password(password):
     # Define the strength criteria
     has_uppercase = any(char.isupper() for char in password)
@@ -61,7 +400,7 @@ def get_master_password():
             print("Passwords do not match or do not meet the strength criteria. Please try again.")
         pass
 
-def save_master_password(password, key, mountpoint):
+def save_master_password(password, key, mountpoint, keystore_dir=KEYSTORE_DIR):
     # Generate a salt and hash the password
     salt = bcrypt.gensalt()
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
@@ -73,12 +412,12 @@ def save_master_password(password, key, mountpoint):
 
     access_info = {mountpoint: access_keys}
     # Save keys to a file or database
-    with open('C://dhckfs/pw.txt', 'wb') as file:
+    with open(os.path.join(keystore_dir, "pw.txt"), 'wb') as file:
         pickle.dump(access_info, file)
 
-def verify_master_password(password, mountpoint):
+def verify_master_password(password, mountpoint, keystore_dir=KEYSTORE_DIR):
     # Retrieve the hashed password from the file or database
-    with open('C://dhckfs/pw.txt', 'rb') as file:
+    with open(os.path.join(keystore_dir, "pw.txt"), 'rb') as file:
         access_info = pickle.load(file)
 
     for mount in access_info:
@@ -0,0 +1,334 @@
+import hashlib
+import os
+import threading
+import weakref
+from types import MappingProxyType
+
+
+#contenuto dei file diviso in blocchi di dimensione fissa
+
+
+CHUNK_SIZE = 64 * 1024
+
+# copied out for the holes of a read, see Extents.read_into
+_ZEROS = memoryview(bytes(CHUNK_SIZE))
+
+# chunks and records of every Extents that has none yet, read only: each
+# Extents allocates its own dicts with the first chunk or record it stores
+_EMPTY = MappingProxyType({})
+
+# guards the switch of a chunk from sealed to decrypted, see Extents._get
+_unseal_lock = threading.Lock()
+
+# identical clean chunks of all files, by digest, see set_dedup
+_blocks = None
+_blocks_lock = threading.Lock()
+
+
+class Block(bytearray):
+    """Chunk shared by every file that holds the same data, never written to.
+
+    Blocks live in `_blocks` as long as a file references them, a file
+    that writes to one first swaps it for a private bytearray.
+    """
+
+    __slots__ = ("__weakref__",)
+
+
+def set_dedup(enabled):
+    """Share identical chunks between files, off by default.
+
+    Chunks are deduplicated once they are clean: when they are decrypted
+    and when a checkpoint has stored them. It costs a hash per chunk.
+    """
+    global _blocks
+    _blocks = weakref.WeakValueDictionary() if enabled else None
+
+
+def _intern(chunk):
+    blocks = _blocks
+    if blocks is None:
+        return chunk
+    digest = hashlib.blake2b(chunk).digest()
+    with _blocks_lock:
+        block = blocks.get(digest)
+        if block is None:
+            block = blocks[digest] = Block(chunk)
+    return block
+
+
+class Extents:
+    """File contents stored as fixed-size chunks.
+
+    Only chunks that have been written are allocated, the others are holes
+    that read as zeros. Growing only moves `size`, shrinking drops the
+    chunks past the new end, so neither copies the data that is kept.
+
+    Chunks loaded from an encrypted volume start out sealed: `_sealed` holds
+    their ciphertext record and they are decrypted one at a time on first
+    access. A record stays in `_sealed` while it still matches the
+    plaintext, so saving only re-encrypts the chunks that were modified.
+    """
+
+    __slots__ = ("chunk_size", "size", "_chunks", "_sealed", "_unseal", "sealed_id")
+
+    def __init__(self, size=0, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.size = size
+        self._chunks = _EMPTY
+        self._sealed = _EMPTY
+        self._unseal = None
+        self.sealed_id = None
+
+    def __len__(self):
+        return self.size
+
+    def resident(self):
+        """Approximate memory held, a chunk per decrypted chunk. Records stay
+        in the blob store until their chunk is decrypted"""
+        return len(self._chunks) * self.chunk_size
+
+    def trim(self, size):
+        """Drop decrypted chunks that still match their record, in the order
+        they were loaded, until at most `size` bytes are resident"""
+        cs = self.chunk_size
+        excess = (len(self._chunks) * cs - size + cs - 1) // cs
+        if excess <= 0:
+            return
+        clean = [index for index in self._chunks if index in self._sealed]
+        for index in clean[:excess]:
+            del self._chunks[index]
+
+    def seal(self, sealed_id, chunk_size, records, unseal):
+        """Use the ciphertext `records` ({index: record}) as the contents.
+
+        `unseal(index, record)` returns the plaintext of a chunk, records may
+        be shorter than a chunk and are padded with zeros.
+        """
+        assert not self._chunks
+        self.sealed_id = sealed_id
+        self.chunk_size = chunk_size
+        self._sealed = records
+        self._unseal = unseal
+
+    def sealed_records(self, length, seal):
+        """Yield the ciphertext record of every chunk of the first `length` bytes.
+
+        Holes yield None. Modified chunks are encrypted with `seal(index, data)`
+        and their new record is kept for the next save.
+        """
+        cs = self.chunk_size
+        if self._sealed is _EMPTY:
+            self._sealed = {}
+        for index in range((length + cs - 1) // cs):
+            record = self._sealed.get(index)
+            if record is None:
+                chunk = self._chunks.get(index)
+                if chunk is not None:
+                    record = self._sealed[index] = seal(index, memoryview(chunk)[: min(cs, length - index * cs)])
+            yield record
+
+    def snapshot(self):
+        """Private copy to encrypt while the file keeps changing.
+
+        Records are shared, only the chunks that have none are copied.
+        """
+        if self.sealed_id is None:
+            self.sealed_id = os.urandom(16)
+        clone = Extents(self.size, self.chunk_size)
+        clone.sealed_id = self.sealed_id
+        clone._sealed = dict(self._sealed)
+        clone._chunks = {
+            index: bytearray(chunk) for index, chunk in self._chunks.items() if index not in self._sealed
+        }
+        return clone
+
+    def adopt(self, snapshot, records, unseal):
+        """Take `records`, those of the packed `snapshot` as they were stored,
+        and `unseal` to decrypt them (see seal) once trim() drops a chunk.
+
+        The contents must not have changed since the snapshot.
+        """
+        self._sealed = records
+        self._unseal = unseal
+        if _blocks is not None:
+            for index in snapshot._chunks:
+                self._chunks[index] = _intern(self._chunks[index])
+
+    def rebase(self, snapshot, records, unseal):
+        """Take the `records` of the packed `snapshot`, as they were stored, for
+        the chunks not modified since, see adopt. For contents modified since"""
+        self._unseal = unseal
+        if self._sealed is _EMPTY:
+            self._sealed = {}
+        sealed = self._sealed
+        for index, record in records.items():
+            old = sealed.get(index)
+            if old is not None:
+                # still the record the snapshot shared
+                if old is snapshot._sealed.get(index):
+                    sealed[index] = record
+            elif index in snapshot._chunks and self._chunks.get(index) == snapshot._chunks[index]:
+                # encrypted by the snapshot, and the same data since
+                sealed[index] = record
+
+    def shared_chunks(self):
+        """The chunks shared through set_dedup"""
+        return [chunk for chunk in list(self._chunks.values()) if type(chunk) is Block]
+
+    def dirty_chunks(self, length):
+        """Yield (index, data) for the chunks of the first `length` bytes without a record"""
+        cs = self.chunk_size
+        for index in range((length + cs - 1) // cs):
+            if index not in self._sealed:
+                chunk = self._chunks.get(index)
+                if chunk is not None:
+                    yield index, memoryview(chunk)[: min(cs, length - index * cs)]
+
+    def set_record(self, index, record):
+        if self._sealed is _EMPTY:
+            self._sealed = {}
+        self._sealed[index] = record
+
+    def _get(self, index):
+        chunk = self._chunks.get(index)
+        if chunk is not None or not self._sealed:
+            return chunk
+        record = self._sealed.get(index)
+        if record is None:
+            # a concurrent reader may have just installed it
+            return self._chunks.get(index)
+        data = self._unseal(index, record)
+        if _blocks is not None:
+            chunk = _intern(data + bytes(self.chunk_size - len(data)))
+        else:
+            chunk = bytearray(self.chunk_size)
+            chunk[: len(data)] = data
+        # concurrent readers may both decrypt, only the first one installs
+        with _unseal_lock:
+            if self._chunks is _EMPTY:
+                self._chunks = {}
+            return self._chunks.setdefault(index, chunk)
+
+    def _writable(self, index, chunk):
+        # copy on write of a shared Block
+        if type(chunk) is Block:
+            chunk = self._chunks[index] = bytearray(chunk)
+        return chunk
+
+    def _drop(self, index):
+        if index in self._chunks:
+            del self._chunks[index]
+        self._forget(index)
+
+    def _forget(self, index):
+        # the record no longer matches the chunk
+        if index in self._sealed:
+            del self._sealed[index]
+
+    def resize(self, size):
+        if size < self.size:
+            cs = self.chunk_size
+            kept = (size + cs - 1) // cs
+            for index in range(kept, (self.size + cs - 1) // cs):
+                self._drop(index)
+            self._zero_chunk_tail(kept - 1, size - (kept - 1) * cs)
+        self.size = size
+
+    def zero(self, start, end):
+        """Turn [start, end) back into zeros, freeing the chunks it fully covers"""
+        end = min(end, self.size)
+        if start >= end:
+            return
+        cs = self.chunk_size
+        first, last = start // cs, (end - 1) // cs
+        if first == last:
+            chunk = self._get(first)
+            if chunk is not None:
+                chunk = self._writable(first, chunk)
+                chunk[start - first * cs : end - first * cs] = bytes(end - start)
+                self._forget(first)
+            return
+        self._zero_chunk_tail(first, start - first * cs)
+        for index in range(first + 1, last):
+            self._drop(index)
+        if end - last * cs == cs:
+            self._drop(last)
+        else:
+            chunk = self._get(last)
+            if chunk is not None:
+                chunk = self._writable(last, chunk)
+                chunk[: end - last * cs] = bytes(end - last * cs)
+                self._forget(last)
+
+    def _zero_chunk_tail(self, index, offset):
+        if offset == 0:
+            self._drop(index)
+            return
+        chunk = self._get(index)
+        if chunk is not None and offset < self.chunk_size:
+            chunk = self._writable(index, chunk)
+            chunk[offset:] = bytes(self.chunk_size - offset)
+            self._forget(index)
+
+    def read(self, start, end):
+        """Return [start, end) as a buffer, a view into the chunk when it fits in one.
+
+        The view is only valid until the next write to the same range, so it
+        must be copied out before the file lock is released. WinFsp reads go
+        through read_into() instead, which copies under the lock.
+        """
+        cs = self.chunk_size
+        index, offset = divmod(start, cs)
+        if end - start <= cs - offset:
+            chunk = self._get(index)
+            if chunk is None:
+                return bytes(end - start)
+            return memoryview(chunk)[offset : offset + end - start]
+        out = bytearray(end - start)
+        self.read_into(start, end, out)
+        return out
+
+    def read_into(self, start, end, out):
+        """Copy [start, end) into the writable buffer `out`, holes as zeros"""
+        cs = self.chunk_size
+        out = memoryview(out)
+        pos = start
+        while pos < end:
+            index, offset = divmod(pos, cs)
+            length = min(cs - offset, end - pos)
+            chunk = self._get(index)
+            if chunk is not None:
+                out[pos - start : pos - start + length] = memoryview(chunk)[offset : offset + length]
+            elif length <= len(_ZEROS):
+                out[pos - start : pos - start + length] = _ZEROS[:length]
+            else:
+                # chunks larger than CHUNK_SIZE, from a volume written with another size
+                out[pos - start : pos - start + length] = bytes(length)
+            pos += length
+
+    def write(self, start, buffer):
+        cs = self.chunk_size
+        view = memoryview(buffer).cast("B")
+        end = start + len(view)
+        if self._chunks is _EMPTY:
+            self._chunks = {}
+        pos = start
+        while pos < end:
+            index, offset = divmod(pos, cs)
+            length = min(cs - offset, end - pos)
+            # a chunk that is fully overwritten is never decrypted
+            if length < cs:
+                chunk = self._get(index)
+            else:
+                chunk = self._chunks.get(index)
+                if type(chunk) is Block:
+                    chunk = None
+            if chunk is None:
+                chunk = self._chunks[index] = bytearray(cs)
+            else:
+                chunk = self._writable(index, chunk)
+            # through a memoryview, assigning to a bytearray slice copies the source first
+            memoryview(chunk)[offset : offset + length] = view[pos - start : pos - start + length]
+            self._forget(index)
+            pos += length
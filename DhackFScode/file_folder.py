@@ -1,15 +1,60 @@
+import threading
+from sortedcontainers import SortedDict
 from winfspy import FILE_ATTRIBUTE, NTStatusEndOfFile
 from winfspy.plumbing.win32_filetime import filetime_now
 
+import extents_fs
+from metadata_fs import FileInfo
+
 
 #classi per la definizione di file e cartelle, file and folder sono sottoclassi di FF
 
 
+# guards the switch from sealed to decrypted contents, see File.seal
+_unseal_lock = threading.Lock()
+
+# serialises moving entries with computing their paths, see FF.path
+_paths_lock = threading.Lock()
+
+# children of every empty Folder, never written to, see Folder.children
+_NO_CHILDREN = SortedDict()
+
+
+def name_key(name):
+    """Key of `name` in Folder.children, names match case-insensitively as in PureWindowsPath"""
+    key = name.lower()
+    # most names are lower case already, share the string
+    return name if key == name else key
+
+
 class FF:
+    __slots__ = ("name", "parent", "_path", "attributes", "security_descriptor", "creation_time",
+                 "last_access_time", "last_write_time", "change_time", "index_number", "file_size")
+
     @property
-    def name(self):
-        """File name, without the path"""
-        return self.path.name
+    def path(self):
+        """Full path, derived from the parent's and cached until the entry or an ancestor moves.
+
+        Invariant: when an entry has no cached path, none of its descendants
+        has one either, so a move only visits the paths cached below it.
+        """
+        path = self._path
+        if path is None:
+            with _paths_lock:
+                path = self._compute_path()
+        return path
+
+    def _compute_path(self):
+        # the nearest ancestor with a cached path, then back down
+        missing = []
+        obj = self
+        while obj._path is None:
+            missing.append(obj)
+            obj = obj.parent
+        path = obj._path
+        for obj in reversed(missing):
+            path = obj._path = path / obj.name
+        return path
 
     @property
     def file_name(self):
@@ -18,7 +63,10 @@ class FF:
 
     def __init__(self, path, attributes, security_descriptor, creation_time=filetime_now(),
                  last_write_time=filetime_now(), change_time=filetime_now(), index_number=0, file_size=0):
-        self.path = path
+        # the root has no parent, the others get theirs from operazioni._link
+        self.name = path.name
+        self.parent = None
+        self._path = path
         self.attributes = attributes
         self.security_descriptor = security_descriptor
         self.creation_time = creation_time
@@ -41,12 +89,50 @@ class FF:
             "index_number": self.index_number,
         }
 
+    def attach(self, parent):
+        """Make this entry a child of `parent`, under its current name"""
+        with _paths_lock:
+            self.parent = parent
+            if parent._path is None:
+                self._path = None
+            parent._add_child(name_key(self.name), self)
+
+    def detach(self):
+        """Remove this entry from its parent, it keeps the path it had for the handles still open"""
+        with _paths_lock:
+            if self._path is None:
+                self._compute_path()
+            self.parent._remove_child(name_key(self.name))
+            self.parent = None
+
+    def move(self, parent, name):
+        """Make this entry `name` in `parent`, O(paths cached in the subtree) instead of O(subtree)"""
+        with _paths_lock:
+            self.parent._remove_child(name_key(self.name))
+            self.parent = parent
+            self.name = name
+            parent._add_child(name_key(name), self)
+            pending = [self]
+            while pending:
+                obj = pending.pop()
+                if obj._path is not None:
+                    obj._path = None
+                    children = getattr(obj, "children", None)
+                    if children:
+                        pending.extend(children.values())
+
+    def record(self, blob_id=None):
+        return FileInfo(self.attributes, self.allocation_size, self.file_size, self.creation_time,
+                        self.last_access_time, self.last_write_time, self.change_time, self.index_number,
+                        blob_id)
+
     def __repr__(self):
         return f"{type(self).__name__}:{self.file_name}"
 
 
 
 class File(FF):
+    __slots__ = ("data", "stored", "sealed", "_unseal")
 
     allocation_unit = 4096
 
@@ -54,7 +140,11 @@ class File(FF):
                  last_write_time=filetime_now(), change_time=filetime_now(), index_number=0, file_size=0):
         super().__init__(path, attributes, security_descriptor, creation_time,
                  last_write_time, change_time, index_number, file_size)
-        self.data = bytearray(allocation_size)
+        self.data = extents_fs.Extents(allocation_size)
+        # blob store id of the contents as of the last checkpoint
+        self.stored = None
+        self.sealed = None
+        self._unseal = None
         self.attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
         assert not self.attributes & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
 
@@ -62,11 +152,37 @@ class File(FF):
     def allocation_size(self):
         return len(self.data)
 
+    def seal(self, sealed, unseal):
+        """Keep `sealed` as the contents until they are first needed.
+
+        `sealed` is a blob store id, or the whole-file Fernet token of a
+        volume written before the chunked format. `unseal(sealed)` returns
+        either the plaintext or an Extents of still encrypted chunks, it only
+        runs on the first data access so sizes and times are served from
+        metadata alone.
+        """
+        self.sealed = sealed
+        self._unseal = unseal
+
+    def materialize(self):
+        sealed = self.sealed
+        if sealed is None:
+            return
+        data = self._unseal(sealed)
+        # concurrent readers may both load, only the first one installs
+        with _unseal_lock:
+            if self.sealed is sealed:
+                if isinstance(data, extents_fs.Extents):
+                    self.data = data
+                else:
+                    self.data.write(0, data)
+                self.sealed = None
+                self._unseal = None
+
     def set_allocation_size(self, allocation_size):
-        if allocation_size < self.allocation_size:
-            self.data = self.data[:allocation_size]
-        if allocation_size > self.allocation_size:
-            self.data += bytearray(allocation_size - self.allocation_size)
+        if self.sealed is not None:
+            self.materialize()
+        self.data.resize(allocation_size)
         assert self.allocation_size == allocation_size
         self.file_size = min(self.file_size, allocation_size)
 
@@ -75,9 +191,10 @@ class File(FF):
         self.set_allocation_size(units * self.allocation_unit)
 
     def set_file_size(self, file_size):
+        if self.sealed is not None:
+            self.materialize()
         if file_size < self.file_size:
-            zeros = bytearray(self.file_size - file_size)
-            self.data[file_size : self.file_size] = zeros
+            self.data.zero(file_size, self.file_size)
         if file_size > self.allocation_size:
             self.adapt_allocation_size(file_size)
         self.file_size = file_size
@@ -85,38 +202,77 @@ class File(FF):
     def read(self, offset, length):
         if offset >= self.file_size:
             raise NTStatusEndOfFile()
+        if self.sealed is not None:
+            self.materialize()
+        end_offset = min(self.file_size, offset + length)
+        return self.data.read(offset, end_offset)
+
+    def read_into(self, buffer, offset, length):
+        """read() straight into `buffer`, returns the number of bytes copied"""
+        if offset >= self.file_size:
+            raise NTStatusEndOfFile()
+        if self.sealed is not None:
+            self.materialize()
         end_offset = min(self.file_size, offset + length)
-        return self.data[offset:end_offset]
+        self.data.read_into(offset, end_offset, buffer)
+        return end_offset - offset
 
     def write(self, buffer, offset, write_to_end_of_file):
+        if self.sealed is not None:
+            self.materialize()
         if write_to_end_of_file:
             offset = self.file_size
         end_offset = offset + len(buffer)
         if end_offset > self.file_size:
             self.set_file_size(end_offset)
-        self.data[offset:end_offset] = buffer
+        self.data.write(offset, buffer)
 
         return len(buffer)
 
     def constrained_write(self, buffer, offset):
         if offset >= self.file_size:
             return 0
+        if self.sealed is not None:
+            self.materialize()
         end_offset = min(self.file_size, offset + len(buffer))
         transferred_length = end_offset - offset
-        self.data[offset:end_offset] = buffer[:transferred_length]
+        self.data.write(offset, memoryview(buffer)[:transferred_length])
         return transferred_length
 
 
 class Folder(FF):
+    __slots__ = ("allocation_size", "_children")
+
     def __init__(self, path, attributes, security_descriptor, creation_time=filetime_now(),
                  last_write_time=filetime_now(), change_time=filetime_now(), index_number=0, file_size=0):
         super().__init__(path, attributes, security_descriptor, creation_time,
                  last_write_time, change_time, index_number, file_size)
         self.allocation_size = 0
+        # allocated with the first child, dropped with the last one
+        self._children = None
         assert self.attributes & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
 
+    @property
+    def children(self):
+        """Direct children by name_key(), in that order. Read only, changed
+        through FF.attach/detach/move under the namespace lock of operazioni"""
+        children = self._children
+        return _NO_CHILDREN if children is None else children
+
+    def _add_child(self, key, obj):
+        if self._children is None:
+            self._children = SortedDict()
+        self._children[key] = obj
+
+    def _remove_child(self, key):
+        del self._children[key]
+        if not self._children:
+            self._children = None
+
 
 class openFF:
+    __slots__ = ("file_obj",)
+
     def __init__(self, file_obj):
         self.file_obj = file_obj
 
@@ -264,10 +264,12 @@ class interfaceVFS:
 
 
 class VFileSys:
-    def __init__(self, mountpoint, operations, persistent, debug=False, **volume_params):
+    def __init__(self, mountpoint, operations, persistent, debug=False, dispatcher_threads=0, **volume_params):
         self.started = False
         
         self.debug = debug
+        # 0 lets WinFsp pick the number of dispatcher threads
+        self.dispatcher_threads = dispatcher_threads
         self.volume_params = volume_params
         self.mountpoint = mountpoint
         self.operations = operations
@@ -314,7 +316,7 @@ class VFileSys:
         result = lib.FspFileSystemSetMountPoint(self._file_system_ptr[0], self.mountpoint)
         if not nt_success(result):
             raise WinFSPyError(f"Cannot mount file system: {cook_ntstatus(result).name}")
-        result = lib.FspFileSystemStartDispatcher(self._file_system_ptr[0], 0)
+        result = lib.FspFileSystemStartDispatcher(self._file_system_ptr[0], self.dispatcher_threads)
         if not nt_success(result):
             raise WinFSPyError(f"Cannot start file system dispatcher: {cook_ntstatus(result).name}")
 
@@ -325,8 +327,9 @@ class VFileSys:
         self._create_file_system()
         self.start()  
 
-    def flush():
-        pass
+    def flush(self):
+        """Make every change made to the volume so far durable"""
+        self.operations.flush(None)
 
 
     def stop(self):
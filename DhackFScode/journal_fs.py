@@ -0,0 +1,240 @@
+import glob
+import logging
+import os
+import pickle
+import struct
+import threading
+
+from cryptography.exceptions import InvalidTag
+
+
+logger = logging.getLogger(__name__)
+
+
+#journal cifrato delle modifiche, riapplicato al mount dopo l'ultimo checkpoint
+
+
+# Every segment is a sequence of records: u32 length, then nonce + AES-GCM of
+# the pickled (operation, *args) tuple, with the segment number and the
+# record sequence number as AAD so records cannot be reordered or moved.
+# Arguments passed as pickle.PickleBuffer (the data of a write) are sealed
+# as records of their own, flagged in the length, right before the record
+# of the operation and bound to its sequence number and their position: they
+# are encrypted straight from the caller's buffer.
+_RECORD_LEN = struct.Struct("<I")
+_RECORD_AAD = struct.Struct("<cQQ")
+_DATA_AAD = struct.Struct("<cQQI")
+_DATA_FLAG = 0x80000000
+
+
+def segment_path(prefix, segment):
+    return f"{prefix}journal.{segment:08d}"
+
+
+def list_segments(prefix):
+    """Numbers of the journal segments on disk, in order"""
+    segments = []
+    for path in glob.glob(glob.escape(prefix) + "journal.*"):
+        suffix = path.rsplit(".", 1)[1]
+        if suffix.isdigit():
+            segments.append(int(suffix))
+    return sorted(segments)
+
+
+def read_segment(prefix, segment, keys, last=False):
+    """Yield the records of a segment.
+
+    A torn or corrupted record ends the segment when it is the `last` one,
+    that is what a crash in the middle of an append leaves behind. Anywhere
+    else it means the journal was tampered with and raises.
+    """
+    with open(segment_path(prefix, segment), "rb") as file:
+        data = file.read()
+    pos = 0
+    seq = 0
+    buffers = []
+    while pos < len(data):
+        try:
+            if pos + _RECORD_LEN.size > len(data):
+                raise ValueError("torn record length")
+            (size,) = _RECORD_LEN.unpack_from(data, pos)
+            flagged = size & _DATA_FLAG
+            size &= ~_DATA_FLAG
+            record = data[pos + _RECORD_LEN.size : pos + _RECORD_LEN.size + size]
+            if len(record) != size:
+                raise ValueError("torn record")
+            if flagged:
+                plain = keys.unseal_record(record, _DATA_AAD.pack(b"D", segment, seq, len(buffers)))
+            else:
+                plain = keys.unseal_record(record, _RECORD_AAD.pack(b"J", segment, seq))
+        except (ValueError, InvalidTag):
+            if last:
+                return
+            raise
+        pos += _RECORD_LEN.size + size
+        if flagged:
+            buffers.append(plain)
+            continue
+        seq += 1
+        entry = pickle.loads(plain, buffers=buffers)
+        buffers = []
+        # None stands for a record that could not be sealed, see Journal.write
+        if entry is not None:
+            yield entry
+    if buffers and not last:
+        raise ValueError("torn record")
+
+
+class Journal:
+    """Append-only encrypted log of the mutations since the last checkpoint.
+
+    Callers hold `lock` around the change they log whenever its order with
+    respect to other records matters (a rename and a write to the same file).
+    Only reserve() needs it: records are pickled and encrypted without any
+    lock, then written in the order they were reserved. With `sync` every
+    record is fsync'ed, otherwise it is only written to the OS, which
+    survives a crash of the process but not of the host.
+    """
+
+    def __init__(self, prefix, keys, segment, sync=False):
+        self.prefix = prefix
+        self.keys = keys
+        self.sync = sync
+        self.lock = threading.RLock()
+        # guards the file, records are written one at a time in sequence order
+        self._order = threading.Condition(threading.Lock())
+        self.size = 0
+        self._open(segment)
+
+    def _open(self, segment):
+        self.segment = segment
+        # sequence numbers reserved and written to the segment so far
+        self._seq = 0
+        self._written = 0
+        # unbuffered, every record goes out in a single write
+        self._file = open(segment_path(self.prefix, segment), "wb", buffering=0)
+
+    def append(self, op, *args):
+        self.write(self.reserve(op, *args))
+
+    def reserve(self, op, *args):
+        """Take the next place in the journal for (op, *args), returns the ticket to write() it with"""
+        with self.lock:
+            seq = self._seq
+            self._seq += 1
+            return self.segment, seq, (op, *args)
+
+    def write(self, ticket):
+        """Encrypt the record of a reserved ticket and write it once the records
+        reserved before it are written"""
+        segment, seq, entry = ticket
+        seal = self.keys.seal_record
+        parts = []
+        try:
+            buffers = []
+            plain = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffers.append)
+            for number, buffer in enumerate(buffers):
+                record = seal(buffer.raw(), _DATA_AAD.pack(b"D", segment, seq, number))
+                parts += (_RECORD_LEN.pack(len(record) | _DATA_FLAG), record)
+            record = seal(plain, _RECORD_AAD.pack(b"J", segment, seq))
+        except BaseException:
+            # the records after it cannot be written without this sequence number
+            record = seal(pickle.dumps(None), _RECORD_AAD.pack(b"J", segment, seq))
+            self._write(seq, _RECORD_LEN.pack(len(record)) + record)
+            raise
+        parts += (_RECORD_LEN.pack(len(record)), record)
+        self._write(seq, b"".join(parts))
+
+    def _write(self, seq, data):
+        with self._order:
+            while self._written != seq:
+                self._order.wait()
+            try:
+                view = memoryview(data)
+                while view:
+                    # raw writes may be short
+                    view = view[self._file.write(view) :]
+                self.size += len(data)
+                if self.sync:
+                    os.fsync(self._file.fileno())
+            finally:
+                self._written += 1
+                self._order.notify_all()
+
+    def _drain(self):
+        # with `lock` held, no new record can be reserved meanwhile
+        with self._order:
+            while self._written != self._seq:
+                self._order.wait()
+
+    def fsync(self):
+        """Make every record appended so far durable"""
+        if self.sync:
+            return
+        with self._order:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Start a new segment, returns its number. Older segments can go once a
+        checkpoint covering them is on disk."""
+        with self.lock:
+            self._drain()
+            self._file.close()
+            self.size = 0
+            self._open(self.segment + 1)
+            return self.segment
+
+    def discard_before(self, segment):
+        for old in list_segments(self.prefix):
+            if old < segment:
+                os.remove(segment_path(self.prefix, old))
+
+    def close(self):
+        with self.lock:
+            self._drain()
+            self._file.close()
+
+
+class Checkpointer(threading.Thread):
+    """Fold the journal into the base image every `interval` seconds, or as soon
+    as the journal grows past `max_bytes`."""
+
+    def __init__(self, journal, checkpoint, interval=300.0, max_bytes=64 * 1024 * 1024, poll=1.0):
+        super().__init__(name="checkpointer", daemon=True)
+        self.journal = journal
+        self.checkpoint = checkpoint
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.poll = poll
+        self._stopped = threading.Event()
+        self._requested = threading.Event()
+
+    def request(self):
+        """Checkpoint at the next poll, without waiting for the interval"""
+        self._requested.set()
+
+    def run(self):
+        waited = 0.0
+        # seconds until the next attempt after a failed checkpoint, backing off
+        # up to `interval`. The journal may look empty then, it was rotated
+        retry = None
+        while not self._stopped.wait(self.poll):
+            waited += self.poll
+            if retry is not None:
+                due = waited >= retry
+            else:
+                due = waited >= self.interval or self.journal.size >= self.max_bytes or self._requested.is_set()
+            if due:
+                self._requested.clear()
+                if retry is not None or self.journal.size:
+                    try:
+                        self.checkpoint()
+                        retry = None
+                    except Exception:
+                        retry = self.poll if retry is None else min(retry * 2, self.interval)
+                        logger.exception("Checkpoint failed, retrying in %.1fs", retry)
+                waited = 0.0
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
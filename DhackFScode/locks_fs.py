@@ -0,0 +1,91 @@
+import threading
+from contextlib import contextmanager
+
+
+#lock lettori/scrittore usati dalle operazioni sui dati dei file
+
+
+class _ReadSide:
+    def __init__(self, rwlock):
+        self._rwlock = rwlock
+
+    def __enter__(self):
+        self._rwlock.acquire_read()
+
+    def __exit__(self, *exc):
+        self._rwlock.release_read()
+
+
+class _WriteSide:
+    def __init__(self, rwlock):
+        self._rwlock = rwlock
+
+    def __enter__(self):
+        self._rwlock.acquire_write()
+
+    def __exit__(self, *exc):
+        self._rwlock.release_write()
+
+
+class RWLock:
+    """Many readers or one writer, waiting writers block new readers"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        self.read = _ReadSide(self)
+        self.write = _WriteSide(self)
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class LockTable:
+    """Fixed pool of RWLocks shared out to file objects by identity.
+
+    Giving every entry of a large volume its own RWLock would cost a
+    Condition per entry, so entries hash onto `size` stripes instead.
+    No operation holds two file locks at once, so sharing a stripe can
+    only delay an operation, never deadlock it.
+    """
+
+    def __init__(self, size=1024):
+        self._locks = [RWLock() for _ in range(size)]
+
+    def lock_for(self, file_obj):
+        return self._locks[(id(file_obj) >> 4) % len(self._locks)]
+
+    @contextmanager
+    def all_write(self):
+        """Hold every stripe for writing, which stops all data I/O"""
+        for lock in self._locks:
+            lock.acquire_write()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._locks):
+                lock.release_write()
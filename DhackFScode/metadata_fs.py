@@ -0,0 +1,86 @@
+import struct
+import zlib
+from collections import namedtuple
+from pathlib import PureWindowsPath
+from sortedcontainers import SortedDict
+
+
+#formato binario dell'immagine dei metadati, al posto del pickle del SortedDict
+
+
+# Metadata of an entry as kept in the metadata tree, a tuple instead of the
+# dict winfspy wants, which FF.get_file_info() only builds at the boundary.
+# `blob_id` is the blob store object of a file, `file_contents` the contents
+# embedded by volumes written before the blob store.
+FileInfo = namedtuple(
+    "FileInfo",
+    ["file_attributes", "allocation_size", "file_size", "creation_time", "last_access_time",
+     "last_write_time", "change_time", "index_number", "blob_id", "file_contents"],
+    defaults=(None, None),
+)
+
+
+# Layout, all little endian:
+#   header   magic, version, journal segment, entry count, name table size
+#   names    every distinct path component once, utf-8, NUL separated
+#   entries  one fixed record per entry, parents before their children:
+#            parent entry (ROOT for the root), name, attributes,
+#            allocation size, file size, the four times, index number,
+#            blob id (all zeros when the file has no contents)
+#   trailer  crc32 of everything before it
+MAGIC = b"DHKM"
+VERSION = 1
+ROOT = 0xFFFFFFFF
+_HEADER = struct.Struct("<4sHQQQ")
+_ENTRY = struct.Struct("<IIIQQQQQQQ16s")
+_TRAILER = struct.Struct("<I")
+_NO_BLOB = bytes(16)
+
+
+def dumps(metadata_tree, segment):
+    """Serialise `metadata_tree` ({path: FileInfo}, sorted) and the journal `segment`"""
+    names = {}
+    index = {}
+    entries = []
+    for number, (path, file_info) in enumerate(metadata_tree.items()):
+        index[path] = number
+        parent = ROOT if path.parent == path else index[path.parent]
+        name = names.setdefault(path.name, len(names))
+        blob_id = file_info.blob_id
+        entries.append(_ENTRY.pack(
+            parent,
+            name,
+            int(file_info.file_attributes),
+            *file_info[1:8],
+            bytes.fromhex(blob_id) if blob_id is not None else _NO_BLOB,
+        ))
+    table = "\0".join(names).encode("utf-8")
+    data = b"".join([_HEADER.pack(MAGIC, VERSION, segment, len(entries), len(table)), table, *entries])
+    return data + _TRAILER.pack(zlib.crc32(data))
+
+
+def loads(data):
+    """Return (metadata tree, journal segment) from dumps() output, in one pass over `data`"""
+    view = memoryview(data)
+    if len(view) < _HEADER.size + _TRAILER.size:
+        raise ValueError("truncated metadata")
+    (crc,) = _TRAILER.unpack_from(view, len(view) - _TRAILER.size)
+    if zlib.crc32(view[: len(view) - _TRAILER.size]) != crc:
+        raise ValueError("corrupted metadata")
+    magic, version, segment, count, table_size = _HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a metadata image")
+    pos = _HEADER.size
+    names = str(view[pos : pos + table_size], "utf-8").split("\0")
+    pos += table_size
+    if pos + count * _ENTRY.size + _TRAILER.size != len(view):
+        raise ValueError("corrupted metadata")
+
+    paths = []
+    items = []
+    root = PureWindowsPath("/")
+    for parent, name, *fields, blob_id in _ENTRY.iter_unpack(view[pos : pos + count * _ENTRY.size]):
+        path = root if parent == ROOT else paths[parent] / names[name]
+        paths.append(path)
+        items.append((path, FileInfo(*fields, blob_id.hex() if blob_id != _NO_BLOB else None)))
+    return SortedDict(items), segment
@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+
+
+#contatori, byte trasferiti e latenze per ogni operazione di operazioni_fs
+
+
+# each power of two of nanoseconds is split in 2**_SUB_BITS linear buckets,
+# which bounds the error of a reported percentile to about 12%
+_SUB_BITS = 3
+
+
+def _bucket(ns):
+    bits = ns.bit_length()
+    if bits <= _SUB_BITS + 1:
+        return ns
+    shift = bits - _SUB_BITS - 1
+    return (shift << _SUB_BITS) + (ns >> shift)
+
+
+def _bucket_upper(index):
+    if index < 1 << (_SUB_BITS + 1):
+        return index
+    shift = (index >> _SUB_BITS) - 1
+    mantissa = index - (shift << _SUB_BITS)
+    return ((mantissa + 1) << shift) - 1
+
+
+class Histogram:
+    """Log-linear latency histogram in nanoseconds"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        index = _bucket(ns)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        rank = pct / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(_bucket_upper(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "p50_us": self.percentile(50) / 1000,
+            "p95_us": self.percentile(95) / 1000,
+            "p99_us": self.percentile(99) / 1000,
+            "max_us": self.max / 1000,
+            "mean_us": self.total / self.count / 1000 if self.count else 0,
+        }
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+        self.lock_wait = Histogram()
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "latency": self.latency.summary(),
+            "lock_wait": self.lock_wait.summary(),
+        }
+
+
+class Metrics:
+    """Per-operation statistics fed by the `operation` decorator"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._started = time.monotonic()
+
+    def record(self, name, lock_wait_ns, exec_ns, nbytes=0, failed=False):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = OperationStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.bytes += nbytes
+            stats.latency.record(exec_ns)
+            stats.lock_wait.record(lock_wait_ns)
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                "elapsed_s": elapsed,
+                "operations": {
+                    name: {**stats.snapshot(), "ops_per_s": stats.calls / elapsed if elapsed else 0}
+                    for name, stats in self._stats.items()
+                },
+            }
+
+    def report(self):
+        snap = self.snapshot()
+        lines = [
+            f"{'operation':20} {'calls':>9} {'errors':>7} {'MiB':>9} "
+            f"{'p50us':>9} {'p95us':>9} {'p99us':>9} {'maxus':>10} {'lockp99us':>10}"
+        ]
+        ops = sorted(snap["operations"].items(), key=lambda kv: -kv[1]["latency"]["mean_us"] * kv[1]["calls"])
+        for name, op in ops:
+            lat = op["latency"]
+            lines.append(
+                f"{name:20} {op['calls']:>9} {op['errors']:>7} {op['bytes'] / 2**20:>9.1f} "
+                f"{lat['p50_us']:>9.1f} {lat['p95_us']:>9.1f} {lat['p99_us']:>9.1f} {lat['max_us']:>10.1f} "
+                f"{op['lock_wait']['p99_us']:>10.1f}"
+            )
+        return "\n".join(lines)
+
+    def dump(self, path):
+        with open(path, "w") as file:
+            json.dump(self.snapshot(), file, indent=1)
+
+
+class MetricsDumper(threading.Thread):
+    """Write a metrics snapshot to `path` every `interval` seconds"""
+
+    def __init__(self, metrics, path, interval=10.0):
+        super().__init__(name="metrics-dumper", daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.metrics.dump(self.path)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.metrics.dump(self.path)
@@ -1,14 +1,18 @@
 import threading
 import logging
-from functools import wraps
+import pickle
+from contextlib import nullcontext
+from functools import partial, wraps
+from itertools import count, islice
 from pathlib import Path, PureWindowsPath
+from time import perf_counter_ns
 from sortedcontainers import SortedDict
-import pickle
 
 from winfspy import (
     BaseFileSystemOperations,
     FILE_ATTRIBUTE,
     CREATE_FILE_CREATE_OPTIONS,
+    NTStatusError,
     NTStatusObjectNameNotFound,
     NTStatusDirectoryNotEmpty,
     NTStatusNotADirectory,
@@ -16,43 +20,187 @@ from winfspy import (
     NTStatusAccessDenied,
     NTStatusMediaWriteProtected,
 )
+from winfspy.plumbing import NTSTATUS, ffi
 from winfspy.plumbing.win32_filetime import filetime_now
-from winfspy.plumbing.security_descriptor import SecurityDescriptor
 
+import blobs_fs
+import cache_fs
+import extents_fs
 import file_folder
 import encrypt_password
+import locks_fs
+import metrics_fs
+import security_fs
+
+
+_NO_LOCK = nullcontext()
+
+# LibreOffice lock files, and anything below them, are left out of the base
+# image, see snapshot()
+_LOCK_FILE = "\\.~lock."
+
+logger = logging.getLogger(__name__)
+
+# log 1 operation every `_log_every`, see set_log_sampling
+_log_every = 1
+_log_counter = count()
+
+
+def set_log_sampling(every):
+    """Only log one operation in `every`, cheap enough to leave on in production"""
+    global _log_every
+    if every < 1:
+        raise ValueError("`every` must be at least 1")
+    _log_every = every
+
+
+class _Lazy:
+    """Defer formatting of a logged value until a handler actually emits it"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return _summarise(self.value)
 
 
-def operation(fn):
+# how many bytes a data callback moved, given its result
+_BYTES_MOVED = {"read": len, "read_into": int, "write": int}
+
+
+def _summarise(value):
+    # data buffers are reported by size, never repr'd
+    if isinstance(value, (bytes, bytearray, memoryview)) or type(value).__name__ == "buffer":
+        return f"<{len(value)} bytes>"
+    if isinstance(value, tuple):
+        return "(" + ", ".join(_summarise(v) for v in value) + ")"
+    return repr(value)
+
+
+def operation(fn=None, *, namespace=False, file_lock=None, contents=False):
+    """Wrap a winfsp callback with logging, locking and metrics.
+
+    `namespace=True` serialises the callback with the other operations that
+    change the tree (create, rename, delete). `file_lock` is "read" or
+    "write" and takes the lock of the file behind the `file_context` passed
+    as first argument. Lock order: a file lock may be held while taking the
+    namespace lock, never the other way round. `contents=True` reports the
+    access to the memory budget, which may evict other files once the lock
+    is released. With a trace (see trace_fs) every call is recorded there.
+    """
+    if fn is None:
+        return lambda fn: operation(fn, namespace=namespace, file_lock=file_lock, contents=contents)
 
     name = fn.__name__
+    bytes_moved = _BYTES_MOVED.get(name)
 
     @wraps(fn)
     def wrapper(self, *args, **kwargs):
         head = args[0] if args else None
         tail = args[1:] if args else ()
+        ns_lock = self._namespace_lock if namespace else _NO_LOCK
+        if file_lock:
+            f_lock = getattr(self._file_locks.lock_for(head.file_obj), file_lock)
+        else:
+            f_lock = _NO_LOCK
+        trace = self.trace
+        if trace is not None:
+            # before the call, a rename changes the path of its context
+            traced_args = trace.summarise(args)
+        start = acquired = perf_counter_ns()
         try:
-            with self._thread_lock:
+            with ns_lock, f_lock:
+                acquired = perf_counter_ns()
+                missed = contents and getattr(head.file_obj, "sealed", None) is not None
                 result = fn(self, *args, **kwargs)
         except Exception as exc:
-            logging.info(f" NOK | {name:20} | {head!r:20} | {tail!r:20} | {exc!r}")
+            end = perf_counter_ns()
+            self.metrics.record(name, acquired - start, end - acquired, failed=True)
+            if trace is not None:
+                trace.record(name, start, end, traced_args, True)
+            if logger.isEnabledFor(logging.INFO) and not next(_log_counter) % _log_every:
+                logger.info(" NOK | %-20s | %-20s | %-20s | %r", name, _Lazy(head), _Lazy(tail), exc)
             raise
         else:
-            logging.info(f" OK! | {name:20} | {head!r:20} | {tail!r:20} | {result!r}")
+            end = perf_counter_ns()
+            self.metrics.record(
+                name, acquired - start, end - acquired,
+                bytes_moved(result) if bytes_moved else 0,
+            )
+            if trace is not None:
+                trace.record(name, start, end, traced_args, False)
+            if contents and self.cache is not None and isinstance(head.file_obj, file_folder.File):
+                self.cache.access(head.file_obj, missed)
+                if self.cache.over_budget:
+                    self._evict(head.file_obj)
+            if logger.isEnabledFor(logging.INFO) and not next(_log_counter) % _log_every:
+                logger.info(" OK! | %-20s | %-20s | %-20s | %s", name, _Lazy(head), _Lazy(tail), _Lazy(result))
             return result
 
     return wrapper
 
 class operazioni(BaseFileSystemOperations):
-    def __init__(self, volume_label, mountpoint, metadata_tree: SortedDict, persistent=True, read_only=False):
+
+    # number of children read from a directory per lock acquisition
+    directory_batch_size = 128
+
+    # threads encrypting contents on store, None uses one per core
+    cipher_workers = None
+
+    def __init__(self, volume_label, mountpoint, metadata_tree: SortedDict, persistent=True, read_only=False,
+                 keys=None, blobs=None, memory_budget=None):
         super().__init__()
         if len(volume_label) > 31:
             raise ValueError("`volume_label` must be 31 characters long max")
 
         self.read_only = read_only
 
-        if persistent:
-            self.metadata_tree = metadata_tree
+        # files whose contents changed since the last store
+        self._dirty = set()
+
+        # one object per distinct descriptor, shared by the entries
+        self._descriptors = security_fs.DescriptorCache()
+
+        # write-ahead log of the mutations, see persistence.open_journal
+        self.journal = None
+
+        # serialises checkpoints, see persistence.checkpoint
+        self.checkpoint_lock = threading.Lock()
+
+        # files being encrypted by a checkpoint, see store_snapshot
+        self._packing = set()
+
+        # metadata of every entry as of the last snapshot, {entry: (parent,
+        # name, record)}, and the entries changed since: snapshot() only
+        # captures those under the locks, see there
+        self._image = {}
+        self._changed = set()
+
+        # memory budget of the contents in bytes, None keeps everything in memory.
+        # Dirty files cannot be evicted before a checkpoint stores them, which
+        # `writeback` (set by the caller, e.g. Checkpointer.request) asks for.
+        self.cache = cache_fs.ContentCache(memory_budget) if memory_budget is not None and persistent else None
+        self.writeback = None
+
+        # trace_fs.TraceWriter recording every operation, set by the caller
+        self.trace = None
+
+        # one key/cipher for the whole mount, loaded on first use
+        if keys is None and persistent:
+            keys = encrypt_password.KeyManager(mountpoint)
+        self.keys = keys
+
+        # encrypted contents, one object per file outside the metadata
+        if blobs is None and persistent:
+            blobs = blobs_fs.BlobStore(mountpoint)
+        self.blobs = blobs
+
+        # `metadata_tree` is only read to build the live objects and _image,
+        # snapshot() serialises from those
+        if metadata_tree is None:
+            metadata_tree = SortedDict()
     
         max_file_nodes = 1024
         max_file_size = 16 * 1024 * 1024
@@ -63,80 +211,85 @@ class operazioni(BaseFileSystemOperations):
             self._root_obj = file_folder.Folder(
                 self._root_path,
                 FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
-                SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"),
+                self._descriptors.from_string(security_fs.DEFAULT_SDDL),
             )
-            self._entries = {self._root_path: self._root_obj}
-            self.metadata_tree[self._root_path] = self._root_obj.get_file_info()
         else:                                   
             file_nodes = len(metadata_tree)  
             folder_attributes = FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY 
             
-            #initialize self._entries
+            #initialize the tree, parents sort before their children
             self._root_path = PureWindowsPath("/")
             self._root_obj = file_folder.Folder(                     
                 self._root_path,
                 FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
-                SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"),
+                self._descriptors.from_string(security_fs.DEFAULT_SDDL),
             )
-            self._entries = {self._root_path: self._root_obj}
-
-            for name in metadata_tree:
-                if str(name).__contains__("\.~lock."):
-                    del metadata_tree[name]
+            folders = {self._root_path: self._root_obj}
 
+            unseal = self.keys.decrypt if self.keys is not None else None
             for name in metadata_tree:
                 file_info = metadata_tree[name]
-                if name == "/":
+                if name == self._root_path:
                     self._root_obj = file_folder.Folder(
                         name,
-                        file_info["file_attributes"],
-                        SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"),
-                        file_info["creation_time"],
-                        file_info["last_write_time"],
-                        file_info["change_time"],
-                        file_info["index_number"],
-                        file_info["file_size"]
+                        file_info.file_attributes,
+                        self._descriptors.from_string(security_fs.DEFAULT_SDDL),
+                        file_info.creation_time,
+                        file_info.last_write_time,
+                        file_info.change_time,
+                        file_info.index_number,
+                        file_info.file_size
                     )
-                    del self._entries[self._root_path]
-                    self._entries = {name: self._root_obj}
+                    folders[self._root_path] = self._root_obj
                 else:
-                    if file_info["file_attributes"] == folder_attributes:
+                    if file_info.file_attributes & folder_attributes:
                         f_obj = file_folder.Folder(
                             name,
-                            file_info["file_attributes"],
-                            SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"),
-                            file_info["creation_time"],
-                            file_info["last_write_time"],
-                            file_info["change_time"],
-                            file_info["index_number"],
-                            file_info["file_size"]
+                            file_info.file_attributes,
+                            self._descriptors.from_string(security_fs.DEFAULT_SDDL),
+                            file_info.creation_time,
+                            file_info.last_write_time,
+                            file_info.change_time,
+                            file_info.index_number,
+                            file_info.file_size
                             )
                     else:
                         f_obj = file_folder.File(
                             name,
-                            file_info["file_attributes"],
-                            SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"),
-                            file_info["allocation_size"],
-                            file_info["creation_time"],
-                            file_info["last_write_time"],
-                            file_info["change_time"],
-                            file_info["index_number"],
-                            file_info["file_size"],
+                            file_info.file_attributes,
+                            self._descriptors.from_string(security_fs.DEFAULT_SDDL),
+                            file_info.allocation_size,
+                            file_info.creation_time,
+                            file_info.last_write_time,
+                            file_info.change_time,
+                            file_info.index_number,
+                            file_info.file_size,
                             )
                         
-                        encrypted_data = file_info["file_contents"]
-                        with open('C://dhckfs/pw.txt', 'rb') as file:
-                            access_info = pickle.load(file)
-
-                        for mount in access_info:
-                            if mount == mountpoint:
-                                access_keys = access_info[mount]
-                                key = access_keys["key"]
-
-                        data = encrypt_password.decrypt_data(encrypted_data, key)
-                        f_obj.write(bytearray(data), 0, True)
+                        # contents stay encrypted until the file is first read or written
+                        blob_id = file_info.blob_id
+                        encrypted_data = file_info.file_contents
+                        if blob_id is not None:
+                            f_obj.seal(blob_id, partial(self._load_blob, file_info.allocation_size))
+                            f_obj.stored = blob_id
+                        elif encrypted_data is None:
+                            pass
+                        elif encrypt_password.is_chunked(encrypted_data):
+                            # embedded in the metadata, moved to the blob store on the next checkpoint
+                            self._seal_chunks(f_obj.data, self.keys.unpack(encrypted_data))
+                            self._dirty.add(f_obj)
+                        else:
+                            # whole-file Fernet token, rewritten as chunks on the next store
+                            f_obj.seal(encrypted_data, unseal)
+                            self._dirty.add(f_obj)
                                 
-                    self._entries[name] = f_obj 
+                    self._link(f_obj, folders[name.parent])
+                    if isinstance(f_obj, file_folder.Folder):
+                        folders[name] = f_obj
+                    self._image[f_obj] = (f_obj.parent, f_obj.name, f_obj.record(getattr(f_obj, "stored", None)))
+        self._image[self._root_obj] = (None, self._root_obj.name, self._root_obj.record())
+        # as loaded, only what the journal replays is new
+        self._changed = set()
                   
     
         self._volume_info = {
@@ -145,8 +298,143 @@ class operazioni(BaseFileSystemOperations):
             "volume_label": volume_label,
         }
         
-        self._thread_lock = threading.Lock()
+        self.metrics = metrics_fs.Metrics()
+
 
+        # create/rename/delete are serialised, data I/O only locks its own file
+        self._namespace_lock = threading.Lock()
+        self._file_locks = locks_fs.LockTable()
+
+
+    def _lookup(self, path):
+        """Entry at `path`, None if there is none. One step per path component,
+        entries are only reachable through their parents' children"""
+        obj = self._root_obj
+        try:
+            for name in path.parts[1:]:
+                # lower() gives the same key as name_key()
+                obj = obj.children.get(name.lower())
+        except AttributeError:
+            # a missing entry (None) or a file on the way
+            return None
+        return obj
+
+    def _walk(self):
+        """Yield (path, entry) for every entry, parents before their children.
+
+        Paths are built from the parent's as the walk goes, the cached ones
+        are used but the others are not cached (see FF.path). Call with the
+        namespace lock held.
+        """
+        pending = [(self._root_obj.path, self._root_obj)]
+        while pending:
+            path, obj = pending.pop()
+            yield path, obj
+            children = getattr(obj, "children", None)
+            if children:
+                pending.extend((child._path or path / child.name, child) for child in reversed(children.values()))
+
+    def _link(self, obj, parent_obj):
+        """Add `obj` to the children of `parent_obj`"""
+        obj.attach(parent_obj)
+        self._changed.add(obj)
+
+    def _unlink(self, obj):
+        """Remove `obj` from its parent's children"""
+        obj.detach()
+        self._changed.add(obj)
+        self._dirty.discard(obj)
+        if self.cache is not None and isinstance(obj, file_folder.File):
+            self.cache.discard(obj)
+
+    def _seal_chunks(self, extents, unpacked):
+        sealed_id, chunk_size, _, records = unpacked
+        extents.seal(sealed_id, chunk_size, records, partial(self.keys.unseal_chunk, sealed_id, chunk_size))
+
+    def _load_blob(self, allocation_size, blob_id):
+        """Read the index of the object of a file on its first access, its
+        chunks are read and decrypted one by one later"""
+        extents = extents_fs.Extents(allocation_size)
+        self._seal_chunks(extents, self.keys.unpack_file(self.blobs.path(blob_id)))
+        return extents
+
+    def _evict(self, current):
+        """Send the least recently used files back to the blob store until under budget.
+
+        Files with changes not stored yet only drop their decrypted chunks that
+        are still stored, see Extents.trim. So does `current`, the file the
+        operation just accessed, once it is the last file left and only down
+        to what the others leave of the budget: a file larger than the budget
+        does not reload everything on each access.
+        """
+        pending = []
+        trim = False
+        for file_obj in self.cache.victims():
+            if file_obj is current:
+                trim = True
+                continue
+            with self._file_locks.lock_for(file_obj).write:
+                if file_obj.parent is None:
+                    # deleted
+                    continue
+                if file_obj in self._dirty or file_obj in self._packing or file_obj.stored is None:
+                    # its modified chunks wait for the writeback, the others can go
+                    if file_obj.sealed is None:
+                        file_obj.data.trim(0)
+                    pending.append(file_obj)
+                    continue
+                if file_obj.sealed is None:
+                    allocation_size = file_obj.allocation_size
+                    file_obj.data = extents_fs.Extents(allocation_size)
+                    file_obj.seal(file_obj.stored, partial(self._load_blob, allocation_size))
+                    self.cache.evicted()
+        for file_obj in pending:
+            self.cache.keep(file_obj)
+        if trim:
+            with self._file_locks.lock_for(current).write:
+                if current.parent is not None:
+                    # what the other files leave of the budget
+                    allowance = self.cache.budget - self.cache.resident
+                    current.data.trim(allowance)
+                    if current.data.resident() > allowance and (current in self._dirty or current in self._packing):
+                        pending.append(current)
+                    self.cache.keep(current)
+        if pending and self.writeback is not None:
+            self.writeback()
+
+    def dedup_stats(self):
+        """Memory saved by the chunks files share, see extents_fs.set_dedup"""
+        logical = 0
+        unique = {}
+        with self._namespace_lock:
+            entries = [obj for _, obj in self._walk()]
+        for obj in entries:
+            if isinstance(obj, file_folder.File):
+                for block in obj.data.shared_chunks():
+                    logical += len(block)
+                    unique[id(block)] = len(block)
+        stored = sum(unique.values())
+        return {
+            "shared_chunks_bytes": logical,
+            "unique_blocks": len(unique),
+            "unique_bytes": stored,
+            "dedup_ratio": logical / stored if stored else 1.0,
+            "saved_bytes": logical - stored,
+        }
+
+    def _log(self, op, *args):
+        if self.journal is not None:
+            self.journal.append(op, *args)
+
+    def _log_file(self, op, file_obj, *args):
+        """Journal a change to `file_obj`, its path is read as the record is
+        reserved, under the journal lock, so the record is ordered with respect
+        to a concurrent rename. It is encrypted and written after the lock"""
+        journal = self.journal
+        if journal is not None:
+            with journal.lock:
+                ticket = journal.reserve(op, file_obj.path, *args)
+            journal.write(ticket)
 
     def _create_directory(self, path):
         path = self._root_path / path
@@ -155,8 +443,7 @@ class operazioni(BaseFileSystemOperations):
             FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
             self._root_obj.security_descriptor,
         )
-        self._entries[path] = obj
-        self.metadata_tree[path] = obj.get_file_info()
+        self._link(obj, self._root_obj)
 
 
     def _import_files(self, file_path):
@@ -170,12 +457,9 @@ class operazioni(BaseFileSystemOperations):
 
         data = file_path.read_bytes()
 
-        self._entries[path] = obj
+        self._link(obj, self._root_obj)
         obj.write(bytearray(data), 0, False)
-        try:
-            self.metadata_tree[path]=obj.get_file_info()
-        except:
-            pass
+        self._dirty.add(obj)
 
     # Winfsp operations
 
@@ -192,9 +476,8 @@ class operazioni(BaseFileSystemOperations):
         file_name = PureWindowsPath(file_name)
 
         # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
+        file_obj = self._lookup(file_name)
+        if file_obj is None:
             raise NTStatusObjectNameNotFound()
 
         return (
@@ -203,7 +486,7 @@ class operazioni(BaseFileSystemOperations):
             file_obj.security_descriptor.size,
         )
 
-    @operation
+    @operation(namespace=True)
     def create(
         self,
         file_name,
@@ -217,55 +500,56 @@ class operazioni(BaseFileSystemOperations):
             raise NTStatusMediaWriteProtected()
 
         file_name = PureWindowsPath(file_name)
+        security_descriptor = self._descriptors.intern(security_descriptor)
 
         # `granted_access` is already handle by winfsp
         # `allocation_size` useless for us
 
         # Retrieve file
-        try:
-            parent_file_obj = self._entries[file_name.parent]
-            if isinstance(parent_file_obj, file_folder.File):
-                raise NTStatusNotADirectory()
-        except KeyError:
+        parent_file_obj = self._lookup(file_name.parent)
+        if parent_file_obj is None:
             raise NTStatusObjectNameNotFound()
+        if isinstance(parent_file_obj, file_folder.File):
+            raise NTStatusNotADirectory()
 
         # File/Folder already exists
-        if file_name in self._entries:
+        if file_folder.name_key(file_name.name) in parent_file_obj.children:
             raise NTStatusObjectNameCollision()
         
 
         if create_options & CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE:
-            file_obj = self._entries[file_name] = file_folder.Folder(
+            file_obj = file_folder.Folder(
                 file_name, file_attributes, security_descriptor,
             )
         else:
-            file_obj = self._entries[file_name] = file_folder.File(
+            file_obj = file_folder.File(
                 file_name,
                 file_attributes,
                 security_descriptor,
                 allocation_size,
             )
-        try:
-            self.metadata_tree[file_name] = file_obj.get_file_info()
-        except:
-            pass
+        self._link(file_obj, parent_file_obj)
+        if isinstance(file_obj, file_folder.File):
+            self._dirty.add(file_obj)
+        self._log("create", file_name, create_options, file_attributes, allocation_size)
         return file_folder.openFF(file_obj)
 
     @operation
     def get_security(self, file_context):
         return file_context.file_obj.security_descriptor
 
-    @operation
+    @operation(file_lock="write")
     def set_security(self, file_context, security_information, modification_descriptor):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
+        # descriptors are shared, evolve() leaves the old one to the other entries
         new_descriptor = file_context.file_obj.security_descriptor.evolve(
             security_information, modification_descriptor
         )
-        file_context.file_obj.security_descriptor = new_descriptor
+        file_context.file_obj.security_descriptor = self._descriptors.intern(new_descriptor)
 
-    @operation
+    @operation(namespace=True)
     def rename(self, file_context, file_name, new_file_name, replace_if_exists):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
@@ -274,39 +558,42 @@ class operazioni(BaseFileSystemOperations):
         new_file_name = PureWindowsPath(new_file_name)
 
         # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-
-        except KeyError:
+        file_obj = self._lookup(file_name)
+        if file_obj is None:
             raise NTStatusObjectNameNotFound()
 
-        if new_file_name in self._entries:
+        replaced_obj = self._lookup(new_file_name)
+        if replaced_obj is not None:
             # Case-sensitive comparison
-            if new_file_name.name != self._entries[new_file_name].path.name:
+            if new_file_name.name != replaced_obj.name:
                 pass
             elif not replace_if_exists:
                 raise NTStatusObjectNameCollision()
             elif not isinstance(file_obj, file_folder.File):
                 raise NTStatusAccessDenied()
 
-        for entry_path in list(self._entries):
-            try:
-                relative = entry_path.relative_to(file_name)
-                new_entry_path = new_file_name / relative
-                entry = self._entries.pop(entry_path)
-                entry.path = new_entry_path
-                self._entries[new_entry_path] = entry
-                try:
-                    for path_key in self.metadata_tree:
-                        if file_name == path_key:
-                            file_metadata=self.metadata_tree[path_key]
-                            del self.metadata_tree[path_key]
-                            self.metadata_tree[new_entry_path] = file_metadata
-                except:
-                    pass
-
-            except ValueError:
-                continue
+        new_parent_obj = self._lookup(new_file_name.parent)
+        if new_parent_obj is None:
+            raise NTStatusObjectNameNotFound()
+        if isinstance(new_parent_obj, file_folder.File):
+            raise NTStatusNotADirectory()
+
+        # A folder cannot move into its own subtree
+        ancestor = new_parent_obj
+        while ancestor is not None:
+            if ancestor is file_obj:
+                raise NTStatusAccessDenied()
+            ancestor = ancestor.parent
+
+        # Drop the replaced entry, if any, before moving the subtree
+        if replaced_obj is not None and replaced_obj is not file_obj:
+            self._unlink(replaced_obj)
+
+        # the subtree moves with its root, the paths below are derived again on use
+        with self.journal.lock if self.journal is not None else _NO_LOCK:
+            file_obj.move(new_parent_obj, new_file_name.name)
+            self._changed.add(file_obj)
+            self._log("rename", file_name, new_file_name, replace_if_exists)
             
 
     @operation
@@ -316,9 +603,8 @@ class operazioni(BaseFileSystemOperations):
         # `granted_access` is already handle by winfsp
 
         # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
+        file_obj = self._lookup(file_name)
+        if file_obj is None:
             raise NTStatusObjectNameNotFound()
 
         return file_folder.openFF(file_obj)
@@ -331,7 +617,7 @@ class operazioni(BaseFileSystemOperations):
     def get_file_info(self, file_context):
         return file_context.file_obj.get_file_info()
 
-    @operation
+    @operation(file_lock="write")
     def set_basic_info(
         self,
         file_context,
@@ -356,103 +642,134 @@ class operazioni(BaseFileSystemOperations):
             file_obj.last_write_time = last_write_time
         if change_time:
             file_obj.change_time = change_time
+        self._changed.add(file_obj)
+        self._log_file("set_basic_info", file_obj, file_attributes, creation_time, last_access_time,
+                       last_write_time, change_time, None)
 
         return file_obj.get_file_info()
 
-    @operation
+    @operation(file_lock="write", contents=True)
     def set_file_size(self, file_context, new_size, set_allocation_size):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
+        self._dirty.add(file_context.file_obj)
         if set_allocation_size:
             file_context.file_obj.set_allocation_size(new_size)
         else:
             file_context.file_obj.set_file_size(new_size)
+        self._log_file("set_file_size", file_context.file_obj, new_size, set_allocation_size)
 
-    @operation
+    @operation(namespace=True)
     def can_delete(self, file_context, file_name: str) -> None:
         file_name = PureWindowsPath(file_name)
 
         # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
+        file_obj = self._lookup(file_name)
+        if file_obj is None:
             raise NTStatusObjectNameNotFound
 
-        if isinstance(file_obj, file_folder.Folder):
-            for entry in self._entries.keys():
-                try:
-                    if entry.relative_to(file_name).parts:
-                        raise NTStatusDirectoryNotEmpty()
-                except ValueError:
-                    continue
+        if isinstance(file_obj, file_folder.Folder) and file_obj.children:
+            raise NTStatusDirectoryNotEmpty()
 
     @operation
     def read_directory(self, file_context, marker):
-        entries = []
         file_obj = file_context.file_obj
 
         # Not a directory
         if isinstance(file_obj, file_folder.File):
             raise NTStatusNotADirectory()
 
-        # The "." and ".." should ONLY be included if the queried directory is not root
-        if file_obj.path != self._root_path:
-            parent_obj = self._entries[file_obj.path.parent]
-            entries.append({"file_name": ".", **file_obj.get_file_info()})
-            entries.append({"file_name": "..", **parent_obj.get_file_info()})
+        return self._iter_directory(file_obj, marker)
 
-        # Loop over all entries
-        for entry_path, entry_obj in self._entries.items():
-            try:
-                relative = entry_path.relative_to(file_obj.path)
-            # Filter out unrelated entries
-            except ValueError:
-                continue
-            # Filter out ourself or our grandchildren
-            if len(relative.parts) != 1:
-                continue
-            # Add direct chidren to the entry list
-            entries.append({"file_name": entry_path.name, **entry_obj.get_file_info()})
+    def _iter_directory(self, file_obj, marker):
+        """Lazily yield the entries following `marker`, in name order.
 
-        # Sort the entries
-        entries = sorted(entries, key=lambda x: x["file_name"])
-
-        # No filtering to apply
-        if marker is None:
-            return entries
-
-        # Filter out all results before the marker
-        for i, entry in enumerate(entries):
-            if entry["file_name"] == marker:
-                return entries[i + 1 :]
+        winfspy stops consuming as soon as the WinFsp buffer is full, so only
+        the requested page is built. Children are read in small batches under
+        the lock, each batch resuming by bisection after the last name seen.
+        """
+        # The "." and ".." should ONLY be included if the queried directory is not root
+        if file_obj is not self._root_obj:
+            if marker is None:
+                yield {"file_name": ".", **file_obj.get_file_info()}
+            if marker is None or marker == ".":
+                parent_obj = file_obj.parent
+                if parent_obj is None:
+                    # deleted while listed
+                    raise NTStatusObjectNameNotFound()
+                yield {"file_name": "..", **parent_obj.get_file_info()}
+            if marker in (".", ".."):
+                marker = None
+
+        key = file_folder.name_key(marker) if marker is not None else None
+        while True:
+            with self._namespace_lock:
+                # a folder allocates its children with the first one, see Folder.children
+                children = file_obj.children
+                if key is None:
+                    keys = children.islice(0, self.directory_batch_size)
+                else:
+                    keys = islice(
+                        children.irange(minimum=key, inclusive=(False, True)),
+                        self.directory_batch_size,
+                    )
+                keys = list(keys)
+                batch = [{"file_name": children[key].name, **children[key].get_file_info()} for key in keys]
+            if not batch:
+                return
+            yield from batch
+            key = keys[-1]
 
     @operation
     def get_dir_info_by_name(self, file_context, file_name):
-        path = file_context.file_obj.path / file_name
-        try:
-            entry_obj = self._entries[path]
-        except KeyError:
+        children = getattr(file_context.file_obj, "children", None)
+        entry_obj = children.get(file_folder.name_key(file_name)) if children is not None else None
+        if entry_obj is None:
             raise NTStatusObjectNameNotFound()
 
         return {"file_name": file_name, **entry_obj.get_file_info()}
 
-    @operation
+    @operation(file_lock="read", contents=True)
     def read(self, file_context, offset, length):
         return file_context.file_obj.read(offset, length)
 
-    @operation
+    @operation(file_lock="read", contents=True)
+    def read_into(self, file_context, buffer, offset, length):
+        return file_context.file_obj.read_into(buffer, offset, length)
+
+    def ll_read(self, file_context, buffer, offset, length, p_bytes_transferred):
+        # the default ll_read copies what read() returns into `buffer` once the
+        # file lock is released, when a write may already have changed the
+        # chunk behind the view: read_into copies while the lock is held
+        try:
+            p_bytes_transferred[0] = self.read_into(
+                ffi.from_handle(file_context), ffi.buffer(buffer, length), offset, length
+            )
+        except NTStatusError as exc:
+            return exc.value
+        except Exception:
+            logger.exception("Unhandled exception in read")
+            return NTSTATUS.STATUS_UNEXPECTED_IO_ERROR
+        return NTSTATUS.STATUS_SUCCESS
+
+    @operation(file_lock="write", contents=True)
     def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
+        self._dirty.add(file_context.file_obj)
         if constrained_io:
-            return file_context.file_obj.constrained_write(buffer, offset)
+            written = file_context.file_obj.constrained_write(buffer, offset)
         else:
-            return file_context.file_obj.write(buffer, offset, write_to_end_of_file)
+            written = file_context.file_obj.write(buffer, offset, write_to_end_of_file)
+        # the data is encrypted into the journal straight from the caller's buffer
+        self._log_file("write", file_context.file_obj, pickle.PickleBuffer(buffer), offset, write_to_end_of_file,
+                       constrained_io)
+        return written
 
 
-    @operation
+    @operation(file_lock="write")
     def cleanup(self, file_context, file_name, flags) -> None:
         if self.read_only:
             raise NTStatusMediaWriteProtected()
@@ -468,16 +785,23 @@ class operazioni(BaseFileSystemOperations):
 
         # Delete
         if flags & FspCleanupDelete:
+            with self._namespace_lock:
 
-            # Check for non-empty direcory
-            if any(key.parent == file_obj.path for key in self._entries):
-                return
+                # Check for non-empty direcory
+                if isinstance(file_obj, file_folder.Folder) and file_obj.children:
+                    return
 
-            # Delete immediately
-            try:
-                del self._entries[file_obj.path]
-            except KeyError:
-                raise NTStatusObjectNameNotFound()
+                # Already deleted through another handle
+                if file_obj.parent is None:
+                    raise NTStatusObjectNameNotFound()
+
+                # Delete immediately
+                self._unlink(file_obj)
+                self._log("delete", file_obj.path)
+
+        if flags & (FspCleanupSetAllocationSize | FspCleanupSetArchiveBit | FspCleanupSetLastAccessTime
+                     | FspCleanupSetLastWriteTime | FspCleanupSetChangeTime):
+            self._changed.add(file_obj)
 
         # Resize
         if flags & FspCleanupSetAllocationSize:
@@ -499,7 +823,7 @@ class operazioni(BaseFileSystemOperations):
         if flags & FspCleanupSetChangeTime:
             file_obj.change_time = filetime_now()
 
-    @operation
+    @operation(file_lock="write", contents=True)
     def overwrite(
         self, file_context, file_attributes, replace_file_attributes: bool, allocation_size: int
     ) -> None:
@@ -507,6 +831,7 @@ class operazioni(BaseFileSystemOperations):
             raise NTStatusMediaWriteProtected()
 
         file_obj = file_context.file_obj
+        self._dirty.add(file_obj)
 
         # File attributes
         file_attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
@@ -523,33 +848,166 @@ class operazioni(BaseFileSystemOperations):
         file_obj.last_access_time = now
         file_obj.last_write_time = now
         file_obj.change_time = now
+        self._log_file("overwrite", file_obj, file_attributes, replace_file_attributes, allocation_size)
 
     @operation
     def flush(self, file_context) -> None:
-        pass
+        # every change since the last checkpoint is in the journal, syncing it
+        # makes this file durable, together with everything logged before it.
+        # WinFsp passes no file_context to flush the whole volume, same thing.
+        if self.journal is not None:
+            self.journal.fsync()
     
-    def store_contents(self, mountpoint):
-        with open('C://dhckfs/pw.txt', 'rb') as file:
-            access_info = pickle.load(file)
-
-        for mount in access_info:
-            if mount == mountpoint:
-                access_keys = access_info[mount] 
-                key = access_keys["key"]
-
-        file_attributes = FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
-        for name in self.metadata_tree:
-            file_info = self.metadata_tree[name]
-            if file_info["file_attributes"] == file_attributes:
-                if str(name).__contains__("\.~lock."):
-                    name = PureWindowsPath(str(name).replace(".~lock.", "").removesuffix("#"))
-                file_obj = self._entries[name]
-                if file_obj.allocation_size == 0:
-                    encrypted_data = None
+    def replay(self, records):
+        """Re-apply journal records on top of the base image loaded at mount,
+        returns how many there were"""
+        journal, self.journal = self.journal, None
+        replayed = 0
+        try:
+            for op, path, *args in records:
+                replayed += 1
+                try:
+                    if op == "create":
+                        create_options, file_attributes, allocation_size = args
+                        self.create(path, create_options, None, file_attributes,
+                                    self._root_obj.security_descriptor, allocation_size)
+                    elif op == "rename":
+                        self.rename(None, path, *args)
+                    else:
+                        file_obj = self._lookup(path)
+                        if file_obj is None:
+                            raise NTStatusObjectNameNotFound()
+                        if op == "delete":
+                            self._unlink(file_obj)
+                        else:
+                            getattr(self, op)(file_folder.openFF(file_obj), *args)
+                except NTStatusObjectNameNotFound:
+                    # an entry the base image leaves out, e.g. a lock file
+                    logger.warning("Journal record %s skipped, %s not found", op, path)
+        finally:
+            self.journal = journal
+        return replayed
+
+    def snapshot(self):
+        """Capture the volume for a checkpoint.
+
+        With every lock held, starts a new journal segment, brings _image up
+        to date with the entries changed since the last snapshot and takes a
+        private copy of the contents modified since. The paths and the tree
+        are built once the locks are released: only the next snapshot
+        changes _image, and checkpoints are serialised. Returns (metadata
+        tree, contents to pack, segment), lock files left out, see
+        store_snapshot for the encryption, which runs without the locks too.
+        """
+        journal = self.journal
+        image = self._image
+        with self._file_locks.all_write(), self._namespace_lock, \
+                journal.lock if journal is not None else _NO_LOCK:
+            segment = journal.rotate() if journal is not None else 0
+            dirty = self._dirty
+            to_pack = []
+            try:
+                for obj in self._changed | dirty:
+                    parent = obj.parent
+                    if parent is None and obj is not self._root_obj:
+                        # deleted
+                        image.pop(obj, None)
+                        continue
+                    if not isinstance(obj, file_folder.File):
+                        image[obj] = (parent, obj.name, obj.record())
+                        continue
+                    if obj in dirty:
+                        if obj.sealed is not None:
+                            # Fernet contents of an older volume, migrated to chunks
+                            obj.materialize()
+                        if obj.file_size == 0:
+                            obj.stored = None
+                        else:
+                            to_pack.append((obj, obj.data.snapshot(), obj.file_size))
+                            self._packing.add(obj)
+                    image[obj] = (parent, obj.name, obj.record(obj.stored))
+            except BaseException:
+                for obj, _, _ in to_pack:
+                    self._packing.discard(obj)
+                raise
+            # from here on the files to pack are store_snapshot's, see there for a failure
+            self._dirty = set()
+            self._changed = set()
+        try:
+            paths = self._image_paths()
+            tree = SortedDict()
+            for obj, (_, _, record) in image.items():
+                path = paths[obj]
+                if _LOCK_FILE not in str(path):
+                    tree[path] = record
+            packed = []
+            for obj, data, file_size in to_pack:
+                if paths[obj] in tree:
+                    packed.append((paths[obj], obj, data, file_size))
                 else:
-                    data = file_obj.read(0, file_obj.allocation_size-1)
-                    encrypted_data = encrypt_password.encrypt_data(data, key)
-                file_info["file_contents"] = encrypted_data
-            else:
-                pass
-                
\ No newline at end of file
+                    self._packing.discard(obj)
+        except BaseException:
+            self._unpack(obj for obj, _, _ in to_pack)
+            raise
+        return tree, packed, segment
+
+    def _image_paths(self):
+        """{entry: path} for every entry of _image, from the parents and names it holds"""
+        image = self._image
+        paths = {self._root_obj: self._root_path}
+        for obj in image:
+            missing = []
+            while obj not in paths:
+                missing.append(obj)
+                obj = image[obj][0]
+            path = paths[obj]
+            for obj in reversed(missing):
+                path = paths[obj] = path / image[obj][1]
+        return paths
+
+    def _unpack(self, file_objs):
+        """Mark files a checkpoint failed to store dirty again, for the next one"""
+        for file_obj in file_objs:
+            with self._file_locks.lock_for(file_obj).write:
+                if file_obj.parent is not None:
+                    self._dirty.add(file_obj)
+                self._packing.discard(file_obj)
+
+    def store_snapshot(self, metadata_tree, to_pack, workers=None):
+        """Encrypt the contents captured by snapshot() into new blob store objects.
+
+        Unmodified chunks keep their stored ciphertext, the others are
+        encrypted on `workers` threads (cipher_workers by default). Files left
+        untouched since the snapshot take the new records, so the next
+        checkpoint does not encrypt them again. On a failure the files not
+        stored yet are marked dirty again before the error propagates.
+        """
+        stored = 0
+        try:
+            keys = self.keys.load()
+            packed = keys.pack_many(
+                ((data, file_size) for _, _, data, file_size in to_pack),
+                workers or self.cipher_workers,
+            )
+            for (path, file_obj, data, _), encrypted_data in zip(to_pack, packed):
+                blob_id = self.blobs.put(encrypted_data)
+                metadata_tree[path] = metadata_tree[path]._replace(blob_id=blob_id)
+                parent, name, _ = self._image[file_obj]
+                self._image[file_obj] = (parent, name, metadata_tree[path])
+                # the file reads its records from the new object from now on,
+                # the one they came from goes with the next sweep
+                sealed_id, chunk_size, _, records = keys.unpack_file(self.blobs.path(blob_id))
+                unseal = partial(keys.unseal_chunk, sealed_id, chunk_size)
+                with self._file_locks.lock_for(file_obj).write:
+                    if file_obj not in self._dirty:
+                        file_obj.data.adopt(data, records, unseal)
+                        file_obj.stored = blob_id
+                    else:
+                        file_obj.data.rebase(data, records, unseal)
+                    self._packing.discard(file_obj)
+                stored += 1
+        except BaseException:
+            # dirty again for the next checkpoint, which also keeps the journal
+            # segments holding their changes until it has stored them
+            self._unpack(file_obj for _, file_obj, _, _ in to_pack[stored:])
+            raise
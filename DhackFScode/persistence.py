@@ -3,8 +3,67 @@ from sortedcontainers import SortedDict
 
 import operazioni_fs
 import encrypt_password
+import journal_fs
+import metadata_fs
 
-def create_metadata_tree(persistent, mountpoint):
+def _metadata_path(mountpoint, keystore_dir):
+    return os.path.join(keystore_dir, str(mountpoint)[0]+"metadata.bin")
+
+
+def _legacy_metadata_path(mountpoint, keystore_dir):
+    return os.path.join(keystore_dir, str(mountpoint)[0]+"metadata_tree.pkl")
+
+
+def _journal_prefix(mountpoint, keystore_dir):
+    return os.path.join(keystore_dir, str(mountpoint)[0])
+
+
+def _read_base(mountpoint, keystore_dir):
+    """Return (metadata tree, first journal segment not covered by it)"""
+    try:
+        with open(_metadata_path(mountpoint, keystore_dir), "rb") as file:
+            return metadata_fs.loads(file.read())
+    except FileNotFoundError:
+        pass
+    # volumes written before the binary format: a pickled tree, preceded by a
+    # {"journal_segment": n} header since the journal exists
+    try:
+        with open(_legacy_metadata_path(mountpoint, keystore_dir), "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                return SortedDict(), 0
+            header = pickle.load(file)
+            if isinstance(header, SortedDict):
+                metadata_tree, segment = header, 0
+            else:
+                metadata_tree, segment = pickle.load(file), header["journal_segment"]
+        return SortedDict((name, _legacy_record(file_info)) for name, file_info in metadata_tree.items()), segment
+    except FileNotFoundError:
+        # volume created but never stored
+        return SortedDict(), 0
+
+
+def _legacy_record(file_info):
+    return metadata_fs.FileInfo(**{field: file_info.get(field) for field in metadata_fs.FileInfo._fields})
+
+
+def _write_base(mountpoint, keystore_dir, metadata_tree, segment):
+    """Replace the base image atomically, a crash leaves either the old or the new one"""
+    path = _metadata_path(mountpoint, keystore_dir)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file:
+        file.write(metadata_fs.dumps(metadata_tree, segment))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    try:
+        os.remove(_legacy_metadata_path(mountpoint, keystore_dir))
+    except FileNotFoundError:
+        pass
+
+
+def create_metadata_tree(persistent, mountpoint, keystore_dir=encrypt_password.KEYSTORE_DIR):
+    """Return (metadata tree, first journal segment not covered by it), see open_journal"""
+    segment = 0
     #non-persistent mode
     if not persistent:
         metadata_tree=None  
@@ -12,17 +71,17 @@ def create_metadata_tree(persistent, mountpoint):
     else:
         #controllo esistenza dati relativi alla partizione
         try: 
-            os.mkdir("C://dhckfs")              
+            os.mkdir(keystore_dir)              
         except:
             pass
         #mpinfo: file contenente i mountpoint a cui sono già associati metadati
         try:                                              
-            filemp=open("C://dhckfs/mpinfo.txt", "x")      
+            filemp=open(os.path.join(keystore_dir, "mpinfo.txt"), "x")      
             filemp.close()
         except FileExistsError:
              pass
         
-        filemp=open("C://dhckfs/mpinfo.txt", "r")
+        filemp=open(os.path.join(keystore_dir, "mpinfo.txt"), "r")
         mdexists=False
         for letter in filemp:
             if str(mountpoint) in letter:
@@ -35,40 +94,71 @@ def create_metadata_tree(persistent, mountpoint):
             encrypt_pw = encrypt_password.generate_random_string(10)
             slt = encrypt_password.generate_random_string(10)
             key = encrypt_password.generate_key(encrypt_pw, slt)
-            encrypt_password.save_master_password(master_password, key, mountpoint)
+            encrypt_password.save_master_password(master_password, key, mountpoint, keystore_dir)
 
-            filemp=open("C://dhckfs/mpinfo.txt", "w")
+            filemp=open(os.path.join(keystore_dir, "mpinfo.txt"), "w")
             filemp.write(str(mountpoint))
             filemp.close()
 
-            #empty tree
+            #empty tree, the base image is written by the first checkpoint
             metadata_tree=SortedDict()      
-            pathprefix="C://dhckfs/"+str(mountpoint)[0]
-            file=open(pathprefix+"metadata_tree.pkl", "x")
-            file.close()
         else:
             #inserimento password
             correct = False
             while correct == False:
                 password = input("Insert password: ")
-                correct = encrypt_password.verify_master_password(password, mountpoint)
+                correct = encrypt_password.verify_master_password(password, mountpoint, keystore_dir)
                 if correct:
                     print("Password ok.")
                 else:
                     print("Incorrect password, try again.")
 
-            #retrieve metadata_tree
-            pathprefix="C://dhckfs/"+str(mountpoint)[0]
-            with open(pathprefix+"metadata_tree.pkl", "rb") as file:
-                metadata_tree = pickle.load(file)           
+            #retrieve metadata_tree, the journal is replayed on top by open_journal
+            metadata_tree, segment = _read_base(mountpoint, keystore_dir)
     
-    return metadata_tree
+    return metadata_tree, segment
+
+
+def checkpoint(operations: operazioni_fs.operazioni, mountpoint, keystore_dir=encrypt_password.KEYSTORE_DIR):
+    """Write a new base image of the volume and drop the journal segments it covers.
 
+    Operations are only stopped while the volume is captured, contents are
+    encrypted and written while they go on, into the next journal segment.
+    """
+    with operations.checkpoint_lock:
+        metadata_tree, to_pack, segment = operations.snapshot()
+        operations.store_snapshot(metadata_tree, to_pack)
+        _write_base(mountpoint, keystore_dir, metadata_tree, segment)
+        if operations.journal is not None:
+            operations.journal.discard_before(segment)
+        # objects of older versions and of deleted files
+        operations.blobs.sweep({file_info.blob_id for file_info in metadata_tree.values()})
+
+
+def open_journal(operations: operazioni_fs.operazioni, mountpoint, base_segment,
+                 keystore_dir=encrypt_password.KEYSTORE_DIR, sync=False):
+    """Replay the journal left by the previous mount and start a new one.
+
+    `base_segment` is the one create_metadata_tree returned with the tree.
+    Whatever was replayed is folded into a fresh base image straight away.
+    """
+    prefix = _journal_prefix(mountpoint, keystore_dir)
+    segments = [segment for segment in journal_fs.list_segments(prefix) if segment >= base_segment]
+    # a crash can only tear the tail of the last segment that was written to
+    written = [segment for segment in segments if os.path.getsize(journal_fs.segment_path(prefix, segment))]
+    replayed = 0
+    for segment in written:
+        last = segment == written[-1]
+        replayed += operations.replay(journal_fs.read_segment(prefix, segment, operations.keys, last=last))
+    operations.journal = journal_fs.Journal(prefix, operations.keys, max(segments + [base_segment]) + 1, sync)
+    if replayed:
+        checkpoint(operations, mountpoint, keystore_dir)
+    else:
+        operations.journal.discard_before(operations.journal.segment)
+    return operations.journal
 
-def store_metadata(operations: operazioni_fs.operazioni, mountpoint):
-    operations.store_contents(mountpoint)
-    pathprefix="C://dhckfs/"+str(mountpoint)[0]
-    with open(pathprefix+"metadata_tree.pkl", "wb") as file:
-        pickle.dump(operations.metadata_tree, file)
-    pass
 
+def store_metadata(operations: operazioni_fs.operazioni, mountpoint, keystore_dir=encrypt_password.KEYSTORE_DIR):
+    checkpoint(operations, mountpoint, keystore_dir)
+    if operations.journal is not None:
+        operations.journal.close()
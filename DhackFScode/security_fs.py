@@ -0,0 +1,42 @@
+import threading
+
+from winfspy.plumbing import ffi
+from winfspy.plumbing.security_descriptor import SecurityDescriptor
+
+
+#descrittori di sicurezza condivisi tra tutte le entry che hanno lo stesso
+
+
+DEFAULT_SDDL = "O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"
+
+
+class DescriptorCache:
+    """Intern SecurityDescriptors by their bytes.
+
+    Most entries of a volume carry the same descriptor, interning parses it
+    once and has every entry point at one object. A descriptor is never
+    modified in place: set_security evolves a new one and interns that, so
+    sharing is copy-on-write. Descriptors stay cached for the whole mount,
+    there are only as many as distinct ACLs on the volume.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_bytes = {}
+        self._by_string = {}
+
+    def intern(self, descriptor):
+        key = ffi.buffer(descriptor.handle, descriptor.size)[:]
+        with self._lock:
+            return self._by_bytes.setdefault(key, descriptor)
+
+    def from_string(self, string_format):
+        descriptor = self._by_string.get(string_format)
+        if descriptor is None:
+            descriptor = self.intern(SecurityDescriptor.from_string(string_format))
+            with self._lock:
+                descriptor = self._by_string.setdefault(string_format, descriptor)
+        return descriptor
+
+    def __len__(self):
+        return len(self._by_bytes)
@@ -0,0 +1,361 @@
+import struct
+import threading
+import time
+from collections import namedtuple
+from pathlib import PureWindowsPath
+from time import perf_counter_ns
+
+from winfspy import CREATE_FILE_CREATE_OPTIONS, FILE_ATTRIBUTE
+
+import file_folder
+import metrics_fs
+
+
+#traccia binaria delle operazioni, senza contenuti, e riesecuzione su un nuovo volume
+
+
+# Layout, all little endian:
+#   header   magic, version, wall clock time of the start in ns
+#   records  a kind byte, then
+#            S  string: id, utf-8 length, utf-8. Names, paths and markers
+#               are written once, the first time they are seen
+#            O  operation: name string id, thread number, start and
+#               duration in ns since the header, failed flag, argument
+#               count, then the arguments, each a tag byte and its value:
+#                 i  integer, i64
+#                 s  string id
+#                 c  file context, the string id of its path at call time
+#                 b  data buffer, only its length (u32), never the contents
+#                 n  anything else (security descriptors, ...), dropped
+# A trace cut short by a crash ends at its last complete record.
+MAGIC = b"DHKT"
+VERSION = 1
+_HEADER = struct.Struct("<4sHQ")
+_STRING = struct.Struct("<IH")
+_OPERATION = struct.Struct("<IHQQBB")
+_INT = struct.Struct("<q")
+_ID = struct.Struct("<I")
+
+TraceRecord = namedtuple("TraceRecord", ["op", "thread", "start_ns", "duration_ns", "failed", "args"])
+# arguments that are not plain values, see the layout above
+Context = namedtuple("Context", ["path"])
+Payload = namedtuple("Payload", ["length"])
+
+
+class TraceWriter:
+    """Binary trace of the operations, fed by the `operation` decorator.
+
+    summarise() captures the arguments before the callback runs, so a file
+    context is traced with the path it had when the call was made. Records
+    are buffered, close() flushes them.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "wb", buffering=1024 * 1024)
+        self._lock = threading.Lock()
+        self._strings = {}
+        self._threads = {}
+        self._start = perf_counter_ns()
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time_ns()))
+
+    def _string(self, value):
+        string_id = self._strings.get(value)
+        if string_id is None:
+            string_id = self._strings[value] = len(self._strings)
+            encoded = value.encode("utf-8")
+            self._file.write(b"S" + _STRING.pack(string_id, len(encoded)) + encoded)
+        return string_id
+
+    def summarise(self, args):
+        """Arguments as (tag, value) pairs, without their data"""
+        out = []
+        for value in args:
+            if isinstance(value, bool):
+                out.append((b"i", int(value)))
+            elif isinstance(value, int):
+                out.append((b"i", value) if -2**63 <= value < 2**63 else (b"n", None))
+            elif isinstance(value, (str, PureWindowsPath)):
+                out.append((b"s", str(value)))
+            elif isinstance(value, file_folder.openFF):
+                out.append((b"c", value.file_obj.file_name))
+            elif isinstance(value, (bytes, bytearray, memoryview)) or type(value).__name__ == "buffer":
+                out.append((b"b", len(value)))
+            else:
+                out.append((b"n", None))
+        return out
+
+    def record(self, name, start_ns, end_ns, args, failed):
+        thread = threading.get_ident()
+        with self._lock:
+            if self._file.closed:
+                return
+            number = self._threads.setdefault(thread, len(self._threads))
+            parts = [b"O", _OPERATION.pack(self._string(name), number, start_ns - self._start,
+                                           end_ns - start_ns, failed, len(args))]
+            for tag, value in args:
+                parts.append(tag)
+                if tag == b"i":
+                    parts.append(_INT.pack(value))
+                elif tag in (b"s", b"c"):
+                    parts.append(_ID.pack(self._string(value)))
+                elif tag == b"b":
+                    parts.append(_ID.pack(value))
+            self._file.write(b"".join(parts))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_trace(path):
+    """Return (wall clock start in ns, list of TraceRecord) of a trace file"""
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version, started = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an operation trace")
+    strings = []
+    records = []
+    pos = _HEADER.size
+    try:
+        while pos < len(data):
+            kind = data[pos : pos + 1]
+            pos += 1
+            if kind == b"S":
+                _, length = _STRING.unpack_from(data, pos)
+                pos += _STRING.size
+                if pos + length > len(data):
+                    break
+                strings.append(str(data[pos : pos + length], "utf-8"))
+                pos += length
+            elif kind == b"O":
+                name, thread, start_ns, duration_ns, failed, argc = _OPERATION.unpack_from(data, pos)
+                pos += _OPERATION.size
+                args = []
+                for _ in range(argc):
+                    # IndexError past the end, a torn record
+                    tag = bytes((data[pos],))
+                    pos += 1
+                    if tag == b"i":
+                        (value,) = _INT.unpack_from(data, pos)
+                        pos += _INT.size
+                    elif tag in (b"s", b"c", b"b"):
+                        (value,) = _ID.unpack_from(data, pos)
+                        pos += _ID.size
+                        if tag == b"s":
+                            value = strings[value]
+                        elif tag == b"c":
+                            value = Context(strings[value])
+                        else:
+                            value = Payload(value)
+                    elif tag == b"n":
+                        value = None
+                    else:
+                        raise ValueError("corrupted trace")
+                    args.append(value)
+                records.append(TraceRecord(strings[name], thread, start_ns, duration_ns, bool(failed), args))
+            else:
+                raise ValueError("corrupted trace")
+    except (struct.error, IndexError):
+        # torn tail
+        pass
+    return started, records
+
+
+# Replay
+
+# operations whose first argument names the entry they act on
+_BY_NAME = {"create", "open", "get_security_by_name"}
+# need a descriptor the trace does not hold
+_NOT_REPLAYED = {"set_security"}
+
+
+def _origin(path, origin):
+    """Name at the start of the trace of `path`, following the renames seen so far"""
+    for ancestor in (path, *path.parents):
+        if ancestor in origin:
+            return origin[ancestor] / path.relative_to(ancestor)
+    return path
+
+
+def _target(record):
+    if not record.args:
+        return None
+    head = record.args[0]
+    if isinstance(head, Context):
+        return PureWindowsPath(head.path)
+    if record.op in _BY_NAME and isinstance(head, str):
+        return PureWindowsPath(head)
+    return None
+
+
+def preexisting(records):
+    """Entries a trace used before creating them, they were on the volume when it started.
+
+    Returns {path: size} for files and {path: None} for folders, named as at
+    the start of the trace. A file gets the size its reads reached.
+    """
+    root = PureWindowsPath("/")
+    created = set()
+    origin = {}
+    entries = {}
+
+    def existing(path):
+        path = _origin(path, origin)
+        if path == root or any(ancestor in created for ancestor in (path, *path.parents)):
+            return None
+        for parent in path.parents:
+            if parent != root:
+                entries[parent] = None
+        entries.setdefault(path, 0)
+        return path
+
+    for record in records:
+        if record.failed:
+            continue
+        path = _target(record)
+        if path is None:
+            continue
+        if record.op == "create":
+            existing(path.parent)
+            created.add(_origin(path, origin))
+            continue
+        source = existing(path)
+        if record.op == "rename":
+            new_path = PureWindowsPath(record.args[2])
+            existing(new_path.parent)
+            origin[new_path] = _origin(path, origin)
+        elif record.op == "read_directory" and source is not None:
+            entries[source] = None
+        elif record.op in ("read", "read_into") and source is not None and entries[source] is not None:
+            offset, length = record.args[-2:]
+            entries[source] = max(entries[source], offset + length)
+    return entries
+
+
+def prepare(operations, records):
+    """Create on the fresh volume of `operations` the entries the trace expects to find"""
+    directory = file_folder.openFF(operations._root_obj)
+    for path, size in sorted(preexisting(records).items(), key=lambda item: len(item[0].parts)):
+        if operations._lookup(path) is not None:
+            continue
+        folder = size is None
+        context = operations.create(
+            str(path),
+            CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE if folder else 0,
+            0,
+            FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY if folder else FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL,
+            directory.file_obj.security_descriptor,
+            0,
+        )
+        if size:
+            operations.write(context, bytes(size), 0, False, False)
+
+
+class _Replayer:
+    def __init__(self, operations, records):
+        self.operations = operations
+        largest = max((arg.length for record in records for arg in record.args if isinstance(arg, Payload)),
+                      default=0)
+        self.zeros = memoryview(bytes(largest))
+        # where read_into copies to
+        self.scratch = memoryview(bytearray(largest))
+        # last object seen at each path, contexts outlive the deletion of their entry
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.ops = 0
+        self.errors = 0
+        self.mismatches = 0
+        self.skipped = 0
+
+    def run(self, record):
+        if record.op in _NOT_REPLAYED:
+            with self.lock:
+                self.skipped += 1
+            return
+        operations = self.operations
+        failed = False
+        try:
+            args = []
+            for value in record.args:
+                if isinstance(value, Context):
+                    path = PureWindowsPath(value.path)
+                    file_obj = operations._lookup(path)
+                    if file_obj is None:
+                        file_obj = self.objects[path]
+                    self.objects[path] = file_obj
+                    value = file_folder.openFF(file_obj)
+                elif isinstance(value, Payload):
+                    value = (self.scratch if record.op == "read_into" else self.zeros)[: value.length]
+                args.append(value)
+            if record.op == "create":
+                args[4] = operations._root_obj.security_descriptor
+            result = getattr(operations, record.op)(*args)
+            if isinstance(result, file_folder.openFF):
+                self.objects[result.file_obj.path] = result.file_obj
+            if record.op == "read_directory":
+                for _ in result:
+                    pass
+        except Exception:
+            failed = True
+        with self.lock:
+            self.ops += 1
+            self.errors += failed
+            self.mismatches += failed != record.failed
+
+
+def replay(operations, records, concurrent=False, speed=1.0):
+    """Drive `operations` with the operations of a trace, data replaced by zeros.
+
+    Entries the trace found on the volume are created first, see prepare().
+    Single threaded, operations run back to back in the order they started.
+    With `concurrent` every traced thread gets its own thread, which starts
+    each operation at its traced time divided by `speed`; when the replay
+    falls behind, operations of different threads can run in another order
+    than traced, which shows as mismatches. A whole
+    read_directory listing is consumed, the trace does not say how much of it
+    winfspy read. Returns counts of operations, errors and mismatches (ops
+    whose outcome differs from the trace) and the time taken, the metrics of
+    `operations` are reset after prepare() so they only cover the replay.
+    """
+    records = sorted(records, key=lambda record: record.start_ns)
+    prepare(operations, records)
+    operations.metrics = metrics_fs.Metrics()
+    replayer = _Replayer(operations, records)
+    if not concurrent:
+        start = time.perf_counter()
+        for record in records:
+            replayer.run(record)
+    else:
+        by_thread = {}
+        for record in records:
+            by_thread.setdefault(record.thread, []).append(record)
+        barrier = threading.Barrier(len(by_thread) + 1)
+        origin = records[0].start_ns if records else 0
+
+        def worker(thread_records):
+            barrier.wait()
+            for record in thread_records:
+                delay = start + (record.start_ns - origin) / speed / 1e9 - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                replayer.run(record)
+
+        threads = [threading.Thread(target=worker, args=(thread_records,), daemon=True)
+                   for thread_records in by_thread.values()]
+        for thread in threads:
+            thread.start()
+        # set before the workers are released, they schedule from it
+        start = time.perf_counter()
+        barrier.wait()
+        for thread in threads:
+            thread.join()
+    return {
+        "ops": replayer.ops,
+        "errors": replayer.errors,
+        "mismatches": replayer.mismatches,
+        "skipped": replayer.skipped,
+        "seconds": time.perf_counter() - start,
+        "traced_seconds": (records[-1].start_ns + records[-1].duration_ns - records[0].start_ns) / 1e9
+        if records else 0.0,
+    }
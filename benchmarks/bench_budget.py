@@ -0,0 +1,200 @@
+"""The memory budget under a volume larger than it, through operazioni.
+
+A persistent volume with --budget-mib of memory budget holds --files files
+of --file-mib each plus one file of --big-mib, larger than the budget on its
+own. After a remount, so that every file starts in the blob store, the
+phases below run through the callbacks, with a checkpointer writing back
+modified files when eviction asks for it, as dhack_main sets it up:
+
+    big_sequential  64 KiB reads of the large file, twice from start to end
+    random_read     4 KiB reads at random offsets of random files
+    new_file        one more file of --file-mib created and written in 64 KiB
+                    blocks, it only reaches the blob store through the
+                    checkpoints of this session; the phases below use it too
+    random_write    4 KiB writes at random offsets of random files
+    verify          every file read back whole and compared with what was written
+
+For each phase: cache hits, misses and evictions, the largest resident size
+seen by the cache, and the bytes read from disk where the OS reports them
+(/proc/self/io). A file larger than the budget must not be reloaded on every
+access: the bytes read from disk for big_sequential stay close to twice the
+size of the file. Modified chunks stay in memory until a checkpoint has
+stored them, so the peak of random_write can go past the budget by what is
+written during one checkpoint. Any difference in the contents fails the run.
+
+    python benchmarks/bench_budget.py --budget-mib 16 --files 8 --file-mib 8 --big-mib 32
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from bench_operazioni import MIB, MOUNTPOINT, STANDIN, Volume
+
+import journal_fs
+import persistence
+
+
+BLOCK = 4096
+SEQUENTIAL_BLOCK = 64 * 1024
+
+
+def disk_read():
+    """Bytes read by this process so far, None where the OS does not report it"""
+    try:
+        with open("/proc/self/io") as file:
+            for line in file:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def build(volume, files, file_size, big_size):
+    """Fill the volume, returns {path: bytearray} of what every file holds"""
+    model = {}
+    sizes = [(f"\\f{number}", file_size) for number in range(files)] + [("\\big", big_size)]
+    for path, size in sizes:
+        context = volume.create(path)
+        data = bytearray(os.urandom(size))
+        for offset in range(0, size, MIB):
+            volume.ops.write(context, memoryview(data)[offset : offset + MIB], offset, False, False)
+        volume.ops.close(context)
+        model[path] = data
+    return model
+
+
+class Phase:
+    def __init__(self, volume, name):
+        self.volume = volume
+        self.name = name
+        self.ops = 0
+        self.bytes = 0
+        self.peak = 0
+
+    def __enter__(self):
+        self.stats = self.volume.ops.cache.stats()
+        self.disk = disk_read()
+        self.start = time.perf_counter()
+        return self
+
+    def done(self, length):
+        self.ops += 1
+        self.bytes += length
+        self.peak = max(self.peak, self.volume.ops.cache.resident)
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        disk = disk_read()
+        stats = self.volume.ops.cache.stats()
+        self.result = {
+            "phase": self.name, "ops": self.ops, "seconds": self.seconds,
+            "mib_per_s": self.bytes / MIB / self.seconds,
+            **{key: stats[key] - self.stats[key] for key in ("hits", "misses", "evictions")},
+            "peak_resident": self.peak,
+            "disk_read": disk - self.disk if disk is not None and self.disk is not None else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-mib", type=int, default=16)
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--file-mib", type=int, default=8)
+    parser.add_argument("--big-mib", type=int, default=32)
+    parser.add_argument("--ops", type=int, default=5000, help="operations of the random phases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    if STANDIN:
+        print("winfspy not available, using benchmarks/standin")
+    budget = args.budget_mib * MIB
+    rnd = random.Random(args.seed)
+    errors = []
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        volume = Volume(directory, budget)
+        model = build(volume, args.files, args.file_mib * MIB, args.big_mib * MIB)
+        volume.unmount()
+        volume.mount()
+        ops = volume.ops
+        checkpointer = journal_fs.Checkpointer(
+            ops.journal, lambda: persistence.checkpoint(ops, MOUNTPOINT, directory), poll=0.05
+        )
+        ops.writeback = checkpointer.request
+        checkpointer.start()
+        paths = sorted(model)
+        contexts = {path: volume.open(path) for path in paths}
+
+        def read(phase, path, offset, length):
+            data = bytes(ops.read(contexts[path], offset, length))
+            if data != model[path][offset : offset + length]:
+                errors.append(f"{phase.name}: {path} differs at {offset}")
+            phase.done(length)
+
+        with Phase(volume, "big_sequential") as phase:
+            for _ in range(2):
+                for offset in range(0, len(model["\\big"]), SEQUENTIAL_BLOCK):
+                    read(phase, "\\big", offset, SEQUENTIAL_BLOCK)
+        results.append(phase.result)
+
+        with Phase(volume, "random_read") as phase:
+            for _ in range(args.ops):
+                path = rnd.choice(paths)
+                read(phase, path, rnd.randrange(len(model[path]) // BLOCK) * BLOCK, BLOCK)
+        results.append(phase.result)
+
+        with Phase(volume, "new_file") as phase:
+            path = "\\new"
+            model[path] = bytearray(os.urandom(args.file_mib * MIB))
+            contexts[path] = volume.create(path)
+            for offset in range(0, len(model[path]), SEQUENTIAL_BLOCK):
+                ops.write(contexts[path], memoryview(model[path])[offset : offset + SEQUENTIAL_BLOCK], offset,
+                          False, False)
+                phase.done(SEQUENTIAL_BLOCK)
+            paths.append(path)
+        results.append(phase.result)
+
+        with Phase(volume, "random_write") as phase:
+            for _ in range(args.ops):
+                path = rnd.choice(paths)
+                offset = rnd.randrange(len(model[path]) // BLOCK) * BLOCK
+                data = os.urandom(BLOCK)
+                ops.write(contexts[path], data, offset, False, False)
+                model[path][offset : offset + BLOCK] = data
+                phase.done(BLOCK)
+        results.append(phase.result)
+
+        with Phase(volume, "verify") as phase:
+            for path in paths:
+                for offset in range(0, len(model[path]), SEQUENTIAL_BLOCK):
+                    read(phase, path, offset, SEQUENTIAL_BLOCK)
+        results.append(phase.result)
+
+        for context in contexts.values():
+            ops.close(context)
+        checkpointer.stop()
+        volume.unmount()
+
+    total = (args.files + 1) * args.file_mib + args.big_mib
+    print(f"volume {total}MiB, budget {args.budget_mib}MiB")
+    for result in results:
+        disk = "n/a" if result["disk_read"] is None else f"{result['disk_read'] / MIB:8.1f}MiB"
+        print(f"{result['phase']:14} {result['ops']:>7} ops {result['mib_per_s']:8.1f}MiB/s "
+              f"hits {result['hits']:>6} misses {result['misses']:>5} evictions {result['evictions']:>5} "
+              f"peak {result['peak_resident'] / MIB:6.1f}MiB  read from disk {disk}")
+    for error in errors[:10]:
+        print("  FAILED", error)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
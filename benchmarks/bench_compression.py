@@ -0,0 +1,94 @@
+"""Store and load cost of chunk compression, on compressible and random data.
+
+Every codec packs the same contents with KeyManager.pack_many, then every
+chunk is decrypted back. Reported: stored size, pack and unpack throughput.
+
+    python benchmarks/bench_compression.py --mib 64
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DhackFScode"))
+
+import encrypt_password
+import extents_fs
+
+
+MOUNTPOINT = "Z:"
+
+
+def text_data(size):
+    words = [
+        "".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(random.randint(2, 10))).encode()
+        for _ in range(2000)
+    ]
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(random.choices(words, k=1000)) + b"\n"
+    return bytes(out[:size])
+
+
+def keystore():
+    directory = tempfile.mkdtemp()
+    key = encrypt_password.generate_key("bench", "bench-salt")
+    encrypt_password.save_master_password("Bench1!pass", key, MOUNTPOINT, directory)
+    return directory
+
+
+def run(directory, codec, level, data, files, workers):
+    keys = encrypt_password.KeyManager(MOUNTPOINT, directory, codec, level).load()
+    size = len(data) // files
+    items = []
+    for number in range(files):
+        extents = extents_fs.Extents(size)
+        extents.write(0, data[number * size : (number + 1) * size])
+        items.append((extents, size))
+
+    start = time.perf_counter()
+    blobs = keys.pack_many(items, workers)
+    pack_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for blob in blobs:
+        sealed_id, chunk_size, _, records = keys.unpack(blob)
+        for index, record in records.items():
+            keys.unseal_chunk(sealed_id, chunk_size, index, record)
+    unpack_s = time.perf_counter() - start
+
+    stored = sum(len(blob) for blob in blobs)
+    mib = len(data) / 2**20
+    return {"codec": codec or "none", "level": level, "stored_mib": stored / 2**20,
+            "ratio": len(data) / stored, "pack_mib_s": mib / pack_s, "unpack_mib_s": mib / unpack_s}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mib", type=int, default=64, help="contents per data set")
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    random.seed(0)
+    directory = keystore()
+    data_sets = {"text": text_data(args.mib * 2**20), "random": os.urandom(args.mib * 2**20)}
+    results = []
+    for name, data in data_sets.items():
+        for codec, level in ((None, None), ("zlib", 1), ("zlib", 6), ("lzma", 0), ("lzma", 6)):
+            result = {"data": name, **run(directory, codec, level, data, args.files, args.workers)}
+            results.append(result)
+            print(f"{name:7} {result['codec']:5} {str(level):5} stored {result['stored_mib']:8.1f}MiB "
+                  f"ratio {result['ratio']:5.2f}  pack {result['pack_mib_s']:8.1f}MiB/s  "
+                  f"unpack {result['unpack_mib_s']:8.1f}MiB/s")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Copies and allocations of the read and write paths of operazioni.
+
+Sequential and random I/O in blocks of 4 KiB to 1 MiB against
+operazioni.read/read_into/write, on a volume without persistence (no journal,
+no encryption), so only the way data moves between the caller's buffer and
+the chunks is measured. The caller's buffer stands for the WinFsp one:
+
+    read       read() then a copy of what it returns into the buffer, as the
+               default winfspy ll_read does
+    read_into  read_into() copying into the buffer, as operazioni.ll_read does
+    write      write() of a memoryview of the buffer
+
+Every mode is timed, then run again under tracemalloc for the bytes it
+allocates per operation (peak over the call, so temporaries count too).
+
+    python benchmarks/bench_io.py --mib 64
+"""
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from common import setup_path
+
+STANDIN = setup_path()
+
+import operazioni_fs
+from winfspy import FILE_ATTRIBUTE
+
+
+MIB = 1024 * 1024
+BLOCKS = [4096, 16384, 65536, 256 * 1024, MIB]
+
+
+def volume(size):
+    ops = operazioni_fs.operazioni("bench", "Z:", None, False)
+    context = ops.create("\\io.bin", 0, 0, FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL, ops._root_obj.security_descriptor, 0)
+    fill = os.urandom(MIB)
+    for offset in range(0, size, MIB):
+        ops.write(context, fill, offset, False, False)
+    return ops, context
+
+
+def runner(ops, context, mode, block, buffer):
+    view = memoryview(buffer)[:block]
+    if mode == "read":
+        def run(offset):
+            data = ops.read(context, offset, block)
+            view[: len(data)] = data
+    elif mode == "read_into":
+        def run(offset):
+            ops.read_into(context, view, offset, block)
+    else:
+        def run(offset):
+            ops.write(context, view, offset, False, False)
+    return run
+
+
+def measure(ops, context, mode, block, offsets, traced):
+    buffer = bytearray(os.urandom(block))
+    run = runner(ops, context, mode, block, buffer)
+    start = time.perf_counter()
+    for offset in offsets:
+        run(offset)
+    seconds = time.perf_counter() - start
+
+    allocated = 0
+    tracemalloc.start()
+    for offset in offsets[:traced]:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run(offset)
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return seconds, allocated / min(traced, len(offsets))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mib", type=int, default=64, help="size of the file")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per random run")
+    parser.add_argument("--traced", type=int, default=200, help="operations measured under tracemalloc")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    if STANDIN:
+        print("winfspy not available, using benchmarks/standin")
+    size = args.mib * MIB
+    ops, context = volume(size)
+    rnd = random.Random(0)
+    results = []
+    for pattern in ("sequential", "random"):
+        for block in BLOCKS:
+            if pattern == "sequential":
+                offsets = list(range(0, size, block))
+            else:
+                offsets = [rnd.randrange(size // block) * block for _ in range(args.ops)]
+            for mode in ("read", "read_into", "write"):
+                seconds, allocated = measure(ops, context, mode, block, offsets, args.traced)
+                result = {"pattern": pattern, "block": block, "mode": mode, "ops": len(offsets),
+                          "ops_per_s": len(offsets) / seconds, "mib_per_s": len(offsets) * block / MIB / seconds,
+                          "allocated_per_op": allocated}
+                results.append(result)
+                print(f"{pattern:10} {block // 1024:5}KiB {mode:9} {result['ops_per_s']:>10.1f}/s "
+                      f"{result['mib_per_s']:9.1f}MiB/s  {allocated:>10.0f} bytes allocated/op")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
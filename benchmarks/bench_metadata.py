@@ -0,0 +1,113 @@
+"""Mount-time load of the metadata image: pickled SortedDict against metadata_fs.
+
+For every size a synthetic volume (100 entries per folder, one in ten a folder) is
+written in both formats, then each image is loaded in a fresh interpreter
+that reports the load time and the memory it grew by.
+
+    python benchmarks/bench_metadata.py --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+from pathlib import PureWindowsPath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DhackFScode"))
+
+from sortedcontainers import SortedDict
+
+import metadata_fs
+
+
+_LOADER = """
+import os, pickle, sys, time
+sys.path.insert(0, {code!r})
+import metadata_fs
+import pathlib, sortedcontainers
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+before = rss()
+start = time.perf_counter()
+with open({path!r}, "rb") as file:
+    data = file.read()
+if {fmt!r} == "pickle":
+    tree = pickle.loads(data)
+else:
+    tree, _ = metadata_fs.loads(data)
+del data
+elapsed = time.perf_counter() - start
+print(elapsed, rss() - before, len(tree))
+"""
+
+
+def synthetic_tree(entries):
+    items = []
+    root = PureWindowsPath("/")
+    now = 133_000_000_000_000_000
+    folder = metadata_fs.FileInfo(16, 0, 0, now, now, now, now, 0)
+    items.append((root, folder))
+    folders = [root]
+    number = 0
+    while len(items) < entries:
+        parent = folders[number // 100]
+        if number % 10 == 9:
+            path = parent / f"dir{number:07d}"
+            items.append((path, folder))
+            folders.append(path)
+        else:
+            path = parent / f"file{number:07d}.txt"
+            items.append((path, metadata_fs.FileInfo(32, 4096, 1234, now, now, now, now, 0, os.urandom(16).hex())))
+        number += 1
+    return SortedDict(items)
+
+
+def legacy_tree(tree):
+    """The tree as pickled before metadata_fs, one dict per entry"""
+    return SortedDict(
+        (path, {field: value for field, value in file_info._asdict().items() if value is not None})
+        for path, file_info in tree.items()
+    )
+
+
+def measure(code, path, fmt):
+    out = subprocess.run([sys.executable, "-c", _LOADER.format(code=code, path=path, fmt=fmt)],
+                         check=True, capture_output=True, text=True).stdout
+    elapsed, rss, count = out.split()
+    return {"load_s": float(elapsed), "rss_mib": int(rss) / 2**20, "entries": int(count),
+            "file_mib": os.path.getsize(path) / 2**20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    code = os.path.dirname(metadata_fs.__file__)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            tree = synthetic_tree(size)
+            pickle_path = os.path.join(directory, "metadata_tree.pkl")
+            binary_path = os.path.join(directory, "metadata.bin")
+            with open(pickle_path, "wb") as file:
+                pickle.dump(legacy_tree(tree), file, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(binary_path, "wb") as file:
+                file.write(metadata_fs.dumps(tree, 0))
+            del tree
+            for fmt, path in (("pickle", pickle_path), ("binary", binary_path)):
+                result = {"format": fmt, "size": size, **measure(code, path, fmt)}
+                results.append(result)
+                print(f"{size:>9} {fmt:7} load {result['load_s']:8.3f}s  rss {result['rss_mib']:8.1f}MiB  "
+                      f"file {result['file_mib']:8.1f}MiB")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
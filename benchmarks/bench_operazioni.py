@@ -0,0 +1,403 @@
+"""In-process benchmarks of operazioni, runnable without WinFsp.
+
+The callbacks are called directly, as winfspy would, on persistent volumes
+in a temporary key store (journal included). winfspy itself is replaced by
+benchmarks/standin when it is not installed, see common.setup_path.
+
+Every scenario reports one or more results: operations, seconds, ops/s and,
+for the data scenarios, MiB/s. --repeat runs the scenarios again and keeps
+the fastest run of each result. With --baseline the results are compared to
+an earlier --json output and the run fails when a result is slower than
+allowed by thresholds.json.
+
+    python benchmarks/bench_operazioni.py --json results.json
+    python benchmarks/bench_operazioni.py --baseline results.json --scale 0.5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from common import BENCHMARKS, setup_path
+
+STANDIN = setup_path()
+
+from winfspy import CREATE_FILE_CREATE_OPTIONS, FILE_ATTRIBUTE
+
+import blobs_fs
+import encrypt_password
+import metrics_fs
+import operazioni_fs
+import persistence
+
+
+MOUNTPOINT = "Z:"
+THRESHOLDS = os.path.join(BENCHMARKS, "thresholds.json")
+
+# FspCleanupDelete, see operazioni.cleanup
+CLEANUP_DELETE = 0x01
+# entries winfspy reads per read_directory call, about a 4 KiB buffer
+DIRECTORY_PAGE = 64
+MIB = 1024 * 1024
+
+
+class Volume:
+    """A persistent volume in its own key store, mounted the way dhack_main does minus the password prompt"""
+
+    def __init__(self, directory, memory_budget=None):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        key = encrypt_password.generate_key("bench", "bench-salt")
+        encrypt_password.save_master_password("Bench1!pass", key, MOUNTPOINT, directory)
+        self.ops = None
+        self.mount()
+
+    def mount(self):
+        metadata_tree, base_segment = persistence._read_base(MOUNTPOINT, self.directory)
+        self.ops = operazioni_fs.operazioni(
+            "bench", MOUNTPOINT, metadata_tree, True,
+            keys=encrypt_password.KeyManager(MOUNTPOINT, self.directory).load(),
+            blobs=blobs_fs.BlobStore(MOUNTPOINT, self.directory),
+            memory_budget=self.memory_budget,
+        )
+        persistence.open_journal(self.ops, MOUNTPOINT, base_segment, self.directory)
+
+    def unmount(self):
+        persistence.store_metadata(self.ops, MOUNTPOINT, self.directory)
+        self.ops = None
+
+    def crash(self):
+        """Drop the mount without a checkpoint, the next mount replays the journal"""
+        self.ops.journal.close()
+        self.ops = None
+
+    def reset_metrics(self):
+        self.ops.metrics = metrics_fs.Metrics()
+
+    def create(self, path, folder=False):
+        ops = self.ops
+        context = ops.create(
+            path,
+            CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE if folder else 0,
+            0,
+            FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY if folder else FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL,
+            ops._root_obj.security_descriptor,
+            0,
+        )
+        return context
+
+    def open(self, path):
+        return self.ops.open(path, 0, 0)
+
+    def delete(self, path):
+        context = self.open(path)
+        self.ops.can_delete(context, path)
+        self.ops.cleanup(context, path, CLEANUP_DELETE)
+        self.ops.close(context)
+
+    def list(self, path):
+        """Read a whole directory one page at a time, returns the number of entries"""
+        context = self.open(path)
+        listed = 0
+        marker = None
+        while True:
+            page = list(self._page(context, marker))
+            if not page:
+                break
+            listed += len(page)
+            marker = page[-1]["file_name"]
+        self.ops.close(context)
+        return listed
+
+    def _page(self, context, marker):
+        for number, entry in enumerate(self.ops.read_directory(context, marker)):
+            yield entry
+            if number + 1 == DIRECTORY_PAGE:
+                return
+
+
+class Timer:
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self._start
+
+
+def result(name, ops, seconds, volume=None, operation=None, nbytes=None):
+    out = {"scenario": name, "ops": ops, "seconds": seconds, "ops_per_s": ops / seconds if seconds else 0.0}
+    if nbytes is not None:
+        out["mib_per_s"] = nbytes / MIB / seconds if seconds else 0.0
+    if volume is not None and operation is not None:
+        stats = volume.ops.metrics.snapshot()["operations"].get(operation)
+        if stats is not None:
+            out["p99_us"] = stats["latency"]["p99_us"]
+    return out
+
+
+def scaled(value, scale):
+    return max(1, int(value * scale))
+
+
+# Scenarios: each one gets a fresh volume and yields its results
+
+SCENARIOS = {}
+
+
+def scenario(fn):
+    SCENARIOS[fn.__name__] = fn
+    return fn
+
+
+@scenario
+def mass_create(volume, scale):
+    folders = scaled(20, scale)
+    files = 1000
+    for folder in range(folders):
+        volume.create(f"\\d{folder}", folder=True)
+    volume.reset_metrics()
+    with Timer() as timer:
+        for folder in range(folders):
+            for number in range(files):
+                volume.ops.close(volume.create(f"\\d{folder}\\f{number}.txt"))
+    yield result("mass_create", folders * files, timer.seconds, volume, "create")
+
+
+@scenario
+def deep_tree(volume, scale):
+    depth = scaled(300, scale)
+    files = 5
+    path = ""
+    volume.reset_metrics()
+    with Timer() as timer:
+        for level in range(depth):
+            path += f"\\level{level}"
+            volume.create(path, folder=True)
+            for number in range(files):
+                volume.create(f"{path}\\f{number}")
+    yield result("deep_tree.create", depth * (files + 1), timer.seconds, volume, "create")
+
+    lookups = scaled(20000, scale)
+    leaf = f"{path}\\f0"
+    volume.reset_metrics()
+    with Timer() as timer:
+        for _ in range(lookups):
+            volume.ops.get_security_by_name(leaf)
+            volume.ops.close(volume.open(leaf))
+    yield result("deep_tree.lookup", lookups, timer.seconds, volume, "open")
+
+
+@scenario
+def large_listing(volume, scale):
+    entries = scaled(50000, scale)
+    volume.create("\\big", folder=True)
+    for number in range(entries):
+        volume.create(f"\\big\\entry{number:07d}")
+    rounds = 3
+    volume.reset_metrics()
+    with Timer() as timer:
+        listed = sum(volume.list("\\big") for _ in range(rounds))
+    assert listed == rounds * (entries + 2)
+    # read_directory hands out a generator, its latency does not cover the listing
+    yield result("large_listing", listed, timer.seconds)
+
+
+@scenario
+def subtree_rename(volume, scale):
+    folders = scaled(100, scale)
+    files = 100
+    volume.create("\\a", folder=True)
+    for folder in range(folders):
+        volume.create(f"\\a\\d{folder}", folder=True)
+        for number in range(files):
+            volume.create(f"\\a\\d{folder}\\f{number}")
+    renames = 20
+    names = ["\\a", "\\b"]
+    volume.reset_metrics()
+    with Timer() as timer:
+        for number in range(renames):
+            volume.ops.rename(None, names[number % 2], names[(number + 1) % 2], False)
+    out = result("subtree_rename", renames, timer.seconds, volume, "rename")
+    out["entries_per_rename"] = folders * (files + 1) + 1
+    yield out
+
+
+@scenario
+def sequential_io(volume, scale):
+    size = scaled(64, scale) * MIB
+    block = 64 * 1024
+    data = os.urandom(block)
+    context = volume.create("\\seq.bin")
+    volume.reset_metrics()
+    with Timer() as timer:
+        for offset in range(0, size, block):
+            volume.ops.write(context, data, offset, False, False)
+    yield result("sequential_io.write", size // block, timer.seconds, volume, "write", size)
+
+    volume.reset_metrics()
+    with Timer() as timer:
+        for offset in range(0, size, block):
+            volume.ops.read(context, offset, block)
+    yield result("sequential_io.read", size // block, timer.seconds, volume, "read", size)
+
+
+@scenario
+def random_io(volume, scale):
+    size = 16 * MIB
+    block = 4096
+    count = scaled(20000, scale)
+    rnd = random.Random(0)
+    data = os.urandom(block)
+    context = volume.create("\\random.bin")
+    volume.ops.set_file_size(context, size, False)
+    offsets = [rnd.randrange(0, size // block) * block for _ in range(count)]
+    volume.reset_metrics()
+    with Timer() as timer:
+        for offset in offsets:
+            volume.ops.write(context, data, offset, False, False)
+    yield result("random_io.write", count, timer.seconds, volume, "write", count * block)
+
+    rnd.shuffle(offsets)
+    volume.reset_metrics()
+    with Timer() as timer:
+        for offset in offsets:
+            volume.ops.read(context, offset, block)
+    yield result("random_io.read", count, timer.seconds, volume, "read", count * block)
+
+
+@scenario
+def delete_storm(volume, scale):
+    folders = scaled(20, scale)
+    files = 1000
+    for folder in range(folders):
+        volume.create(f"\\d{folder}", folder=True)
+        for number in range(files):
+            context = volume.create(f"\\d{folder}\\f{number}")
+            volume.ops.write(context, b"x" * 100, 0, False, False)
+    volume.reset_metrics()
+    with Timer() as timer:
+        for folder in range(folders):
+            for number in range(files):
+                volume.delete(f"\\d{folder}\\f{number}")
+            volume.delete(f"\\d{folder}")
+    assert not volume.ops._root_obj.children
+    yield result("delete_storm", folders * (files + 1), timer.seconds, volume, "cleanup")
+
+
+@scenario
+def persistence_cycle(volume, scale):
+    folders = scaled(20, scale)
+    files = 500
+    data = os.urandom(4096)
+    for folder in range(folders):
+        volume.create(f"\\d{folder}", folder=True)
+        for number in range(files):
+            context = volume.create(f"\\d{folder}\\f{number}")
+            volume.ops.write(context, data, 0, False, False)
+    entries = folders * (files + 1)
+
+    with Timer() as timer:
+        volume.unmount()
+    yield result("persistence.unmount", entries, timer.seconds)
+
+    with Timer() as timer:
+        volume.mount()
+    yield result("persistence.mount", entries, timer.seconds)
+
+    with Timer() as timer:
+        for folder in range(folders):
+            for number in range(files):
+                volume.ops.read(volume.open(f"\\d{folder}\\f{number}"), 0, 4096)
+    yield result("persistence.first_read", folders * files, timer.seconds, nbytes=folders * files * 4096)
+
+    # journal left by a crash: replayed then folded into a new base image
+    for number in range(scaled(5000, scale)):
+        volume.create(f"\\d0\\new{number}")
+    volume.crash()
+    with Timer() as timer:
+        volume.mount()
+    yield result("persistence.replay", scaled(5000, scale), timer.seconds)
+
+
+# Regression check
+
+def load_thresholds(path=THRESHOLDS):
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(results, baseline, thresholds):
+    """Return the results slower than `baseline` by more than their tolerance"""
+    previous = {entry["scenario"]: entry for entry in baseline}
+    tolerances = thresholds.get("tolerance", {})
+    default = thresholds.get("default_tolerance", 0.25)
+    regressions = []
+    for entry in results:
+        old = previous.get(entry["scenario"])
+        if old is None or not old["ops_per_s"]:
+            continue
+        ratio = entry["ops_per_s"] / old["ops_per_s"]
+        tolerance = tolerances.get(entry["scenario"], default)
+        if ratio < 1 - tolerance:
+            regressions.append({"scenario": entry["scenario"], "ratio": ratio, "tolerance": tolerance})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the size of every scenario")
+    parser.add_argument("--repeat", type=int, default=1, help="keep the fastest of this many runs")
+    parser.add_argument("--json", type=str, default=None, help="write the results to this file")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="--json output of an earlier run, fail on results slower than thresholds.json allows")
+    parser.add_argument("--thresholds", type=str, default=THRESHOLDS)
+    args = parser.parse_args()
+
+    if STANDIN:
+        print("winfspy not available, using benchmarks/standin")
+    best = {}
+    for name in args.scenarios:
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as directory:
+                volume = Volume(directory)
+                for entry in SCENARIOS[name](volume, args.scale):
+                    if entry["scenario"] not in best or entry["ops_per_s"] > best[entry["scenario"]]["ops_per_s"]:
+                        best[entry["scenario"]] = entry
+                if volume.ops is not None:
+                    volume.ops.journal.close()
+    results = list(best.values())
+    for entry in results:
+        rate = f"  {entry['mib_per_s']:9.1f}MiB/s" if "mib_per_s" in entry else ""
+        p99 = f"  p99 {entry['p99_us']:9.1f}us" if "p99_us" in entry else ""
+        print(f"{entry['scenario']:24} {entry['ops']:>9} ops {entry['seconds']:8.3f}s "
+              f"{entry['ops_per_s']:>12.1f}/s{rate}{p99}")
+
+    report = {"scale": args.scale, "repeat": args.repeat, "standin": STANDIN, "python": sys.version.split()[0], "results": results}
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("scale") != args.scale:
+            print(f"warning: baseline ran at scale {baseline.get('scale')}, this run at {args.scale}")
+        regressions = compare(results, baseline["results"], load_thresholds(args.thresholds))
+        for regression in regressions:
+            print(f"REGRESSION {regression['scenario']}: {regression['ratio']:.2f}x the baseline, "
+                  f"tolerance {regression['tolerance']:.0%}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Speedup of KeyManager.pack_many against the number of cipher workers.
+
+The same files are packed with 1, 2, 4, ... workers, up to the core count
+unless --workers lists them, every run on fresh Extents so that every chunk
+is encrypted. Each run is then decrypted and compared with the data, and its
+chunk layout with the serial run: the output must not depend on the number
+of workers, only the random nonces differ.
+
+The workers only overlap inside the cipher calls that release the GIL, the
+speedup shown is what the interpreter and the cryptography build allow.
+
+    python benchmarks/bench_pack.py --mib 256 --files 64
+"""
+import argparse
+import json
+import os
+import time
+
+from common import setup_path
+
+setup_path()
+
+import encrypt_password
+import extents_fs
+from bench_compression import keystore, MOUNTPOINT
+
+
+def items(data, files):
+    size = len(data) // files
+    out = []
+    for number in range(files):
+        extents = extents_fs.Extents(size)
+        extents.write(0, data[number * size : (number + 1) * size])
+        out.append((extents, size))
+    return out
+
+
+def layout(keys, blob):
+    """Chunk indexes and plaintexts of a packed blob"""
+    sealed_id, chunk_size, length, records = keys.unpack(blob)
+    return length, [(index, bytes(keys.unseal_chunk(sealed_id, chunk_size, index, record)))
+                    for index, record in sorted(records.items())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mib", type=int, default=256, help="contents packed by every run")
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--workers", type=int, nargs="+", default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="keep the fastest of this many runs")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    counts = args.workers
+    if counts is None:
+        counts = [1]
+        while counts[-1] * 2 <= cores:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != cores:
+            counts.append(cores)
+    print(f"{cores} cores")
+
+    keys = encrypt_password.KeyManager(MOUNTPOINT, keystore()).load()
+    data = os.urandom(args.mib * 2**20)
+    expected = None
+    serial = None
+    results = []
+    for workers in counts:
+        best = None
+        for _ in range(args.repeat):
+            packing = items(data, args.files)
+            start = time.perf_counter()
+            blobs = keys.pack_many(packing, workers)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        layouts = [layout(keys, blob) for blob in blobs]
+        if expected is None:
+            expected = layouts
+            size = len(data) // args.files
+            for number, (length, chunks) in enumerate(layouts):
+                assert b"".join(chunk for _, chunk in chunks)[:length] == data[number * size : (number + 1) * size]
+        elif layouts != expected:
+            raise SystemExit(f"{workers} workers: output differs from the serial run")
+        serial = serial or best
+        result = {"workers": workers, "mib": args.mib, "seconds": best, "mib_per_s": args.mib / best,
+                  "speedup": serial / best}
+        results.append(result)
+        print(f"{workers:3} workers {best:8.3f}s {result['mib_per_s']:9.1f}MiB/s speedup {result['speedup']:5.2f}x")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
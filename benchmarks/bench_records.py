@@ -0,0 +1,157 @@
+"""Memory held per entry: metadata records and live file objects.
+
+Builds `--entries` records of each kind and reports the bytes they grew the
+heap by (tracemalloc), per entry:
+
+    tree dict     a dict per entry, the metadata tree before metadata_fs.FileInfo
+    tree tuple    a metadata_fs.FileInfo per entry
+    file dict     File objects with a __dict__, as before __slots__
+    file slots    file_folder.File objects
+    folder dict   empty Folder objects with a __dict__ and a SortedDict each
+    folder slots  empty file_folder.Folder objects
+
+Files hold no contents, as after a mount: their chunk and record dicts are
+only allocated with the first chunk or record (see extents_fs.Extents), the
+children of a folder with the first child.
+
+file_folder imports winfspy, replaced by benchmarks/standin where it is not
+installed.
+
+    python benchmarks/bench_records.py --entries 1000000
+"""
+import argparse
+import gc
+import json
+import os
+import tracemalloc
+from pathlib import PureWindowsPath
+
+from sortedcontainers import SortedDict
+
+from common import setup_path
+
+setup_path()
+
+import extents_fs
+import file_folder
+import metadata_fs
+
+
+NOW = 133_000_000_000_000_000
+# shared by every entry, as the interned descriptors and paths of a real volume are
+# not what is being measured
+SECURITY_DESCRIPTOR = object()
+PATH = PureWindowsPath("/folder/file.txt")
+FOLDER_PATH = PureWindowsPath("/folder/sub")
+FOLDER = 0x10
+
+
+class DictFile:
+    """file_folder.File with a __dict__ instead of __slots__, same attributes"""
+
+    def __init__(self, path, attributes, security_descriptor, allocation_size=0, creation_time=NOW,
+                 last_write_time=NOW, change_time=NOW, index_number=0, file_size=0):
+        self.name = path.name
+        self.parent = None
+        self._path = path
+        self.attributes = attributes
+        self.security_descriptor = security_descriptor
+        self.creation_time = creation_time
+        self.last_access_time = NOW
+        self.last_write_time = last_write_time
+        self.change_time = change_time
+        self.index_number = index_number
+        self.file_size = file_size
+        self.data = extents_fs.Extents(allocation_size)
+        self.stored = None
+        self.sealed = None
+        self._unseal = None
+
+
+class DictFolder:
+    """file_folder.Folder with a __dict__ and a SortedDict of its own, as before
+    children were allocated with the first one"""
+
+    def __init__(self, path, attributes, security_descriptor, creation_time=NOW, last_write_time=NOW,
+                 change_time=NOW, index_number=0, file_size=0):
+        self.name = path.name
+        self.parent = None
+        self._path = path
+        self.attributes = attributes
+        self.security_descriptor = security_descriptor
+        self.creation_time = creation_time
+        self.last_access_time = NOW
+        self.last_write_time = last_write_time
+        self.change_time = change_time
+        self.index_number = index_number
+        self.file_size = file_size
+        self.allocation_size = 0
+        self.children = SortedDict()
+
+
+def tree_dict(number):
+    return {
+        "file_attributes": 32, "allocation_size": 4096, "file_size": 1234 + number,
+        "creation_time": NOW + number, "last_access_time": NOW + number,
+        "last_write_time": NOW + number, "change_time": NOW + number,
+        "index_number": 0, "blob_id": os.urandom(16).hex(),
+    }
+
+
+def tree_tuple(number):
+    return metadata_fs.FileInfo(32, 4096, 1234 + number, NOW + number, NOW + number, NOW + number,
+                                NOW + number, 0, os.urandom(16).hex())
+
+
+def file_dict(number):
+    return DictFile(PATH, 32, SECURITY_DESCRIPTOR, creation_time=NOW + number, last_write_time=NOW + number,
+                    change_time=NOW + number, file_size=1234 + number)
+
+
+def file_slots(number):
+    return file_folder.File(PATH, 32, SECURITY_DESCRIPTOR, creation_time=NOW + number,
+                            last_write_time=NOW + number, change_time=NOW + number, file_size=1234 + number)
+
+
+def folder_dict(number):
+    return DictFolder(FOLDER_PATH, FOLDER, SECURITY_DESCRIPTOR, creation_time=NOW + number,
+                      last_write_time=NOW + number, change_time=NOW + number)
+
+
+def folder_slots(number):
+    return file_folder.Folder(FOLDER_PATH, FOLDER, SECURITY_DESCRIPTOR, creation_time=NOW + number,
+                              last_write_time=NOW + number, change_time=NOW + number)
+
+
+def measure(build, entries):
+    gc.collect()
+    tracemalloc.start()
+    records = [build(number) for number in range(entries)]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return {"mib": size / 2**20, "bytes_per_entry": size / entries, "peak_mib": peak / 2**20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    kinds = [("tree dict", tree_dict), ("tree tuple", tree_tuple), ("file dict", file_dict), ("file slots", file_slots),
+             ("folder dict", folder_dict), ("folder slots", folder_slots)]
+
+    results = []
+    for kind, build in kinds:
+        result = {"kind": kind, "entries": args.entries, **measure(build, args.entries)}
+        results.append(result)
+        print(f"{kind:12} {args.entries:>9} entries {result['mib']:9.1f}MiB  "
+              f"{result['bytes_per_entry']:7.1f} bytes/entry")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
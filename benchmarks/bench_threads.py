@@ -0,0 +1,149 @@
+"""Multi-threaded stress test of operazioni: throughput against thread count.
+
+Every thread drives the callbacks of one shared volume directly, as the
+WinFsp dispatcher threads would: 4 KiB reads and writes of its own files,
+get_file_info, open/close by name, and every so often a create and delete in
+a shared folder, which take the namespace lock. At the end the contents of
+every file are read back and compared with what its thread wrote, a torn or
+lost write fails the run.
+
+--global-lock wraps every call in one lock, as the single _thread_lock did
+before the namespace and per-file locks: the gap between the two runs is
+what splitting the lock buys. With the GIL, threads only overlap while a
+callback waits or runs code that releases it (I/O, hashing, encryption), so
+the scaling depends on the interpreter as much as on the locks.
+
+    python benchmarks/bench_threads.py --threads 1 2 4 8 --seconds 3
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+
+from bench_operazioni import CLEANUP_DELETE, STANDIN, Volume
+
+
+BLOCK = 4096
+FILES_PER_THREAD = 4
+FILE_SIZE = 256 * BLOCK
+
+
+def worker(volume, number, deadline, lock, counts, errors, barrier):
+    ops = volume.ops
+    rnd = random.Random(number)
+    folder = f"\\t{number}"
+    names = [f"{folder}\\f{index}" for index in range(FILES_PER_THREAD)]
+    contexts = [ops.open(name, 0, 0) for name in names]
+    # what each file should hold, checked at the end
+    expected = [bytearray(FILE_SIZE) for _ in names]
+    done = 0
+    barrier.wait()
+    try:
+        while time.perf_counter() < deadline:
+            index = rnd.randrange(FILES_PER_THREAD)
+            context = contexts[index]
+            offset = rnd.randrange(FILE_SIZE // BLOCK) * BLOCK
+            choice = rnd.random()
+            with lock:
+                if choice < 0.4:
+                    ops.read(context, offset, BLOCK)
+                elif choice < 0.6:
+                    data = bytes((number,)) * 8 + done.to_bytes(8, "little") + os.urandom(BLOCK - 16)
+                    ops.write(context, data, offset, False, False)
+                    expected[index][offset : offset + BLOCK] = data
+                elif choice < 0.8:
+                    ops.get_file_info(context)
+                elif choice < 0.95:
+                    ops.close(ops.open(names[index], 0, 0))
+                else:
+                    name = f"\\shared\\t{number}-{done}"
+                    ops.close(volume.create(name))
+                    context = ops.open(name, 0, 0)
+                    ops.can_delete(context, name)
+                    ops.cleanup(context, name, CLEANUP_DELETE)
+                    ops.close(context)
+            done += 1
+    except Exception as exc:
+        errors.append(f"thread {number}: {exc!r}")
+    counts[number] = done
+
+    for index, context in enumerate(contexts):
+        stored = bytes(ops.read(context, 0, FILE_SIZE))
+        if stored != expected[index]:
+            errors.append(f"thread {number}: {names[index]} does not hold what was written")
+        ops.close(context)
+
+
+def run(threads, seconds, global_lock):
+    with tempfile.TemporaryDirectory() as directory:
+        volume = Volume(directory)
+        volume.create("\\shared", folder=True)
+        for number in range(threads):
+            volume.create(f"\\t{number}", folder=True)
+            for index in range(FILES_PER_THREAD):
+                context = volume.create(f"\\t{number}\\f{index}")
+                volume.ops.set_file_size(context, FILE_SIZE, False)
+                volume.ops.close(context)
+        volume.reset_metrics()
+
+        lock = threading.Lock() if global_lock else nullcontext()
+        counts = [0] * threads
+        errors = []
+        barrier = threading.Barrier(threads + 1)
+        deadline = time.perf_counter() + seconds + 0.1
+        workers = [
+            threading.Thread(target=worker, args=(volume, number, deadline, lock, counts, errors, barrier))
+            for number in range(threads)
+        ]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        elapsed = min(time.perf_counter(), deadline) - start
+        volume.ops.journal.close()
+    ops = sum(counts)
+    return {"threads": threads, "global_lock": global_lock, "ops": ops, "seconds": elapsed,
+            "ops_per_s": ops / elapsed, "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=3.0, help="length of every run")
+    parser.add_argument("--global-lock", action="store_true", help="also run every count under one lock")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    if STANDIN:
+        print("winfspy not available, using benchmarks/standin")
+    print(f"{os.cpu_count()} cores")
+    results = []
+    failed = False
+    for global_lock in (False, True) if args.global_lock else (False,):
+        single = None
+        for threads in args.threads:
+            result = run(threads, args.seconds, global_lock)
+            single = single or result["ops_per_s"]
+            result["speedup"] = result["ops_per_s"] / single
+            results.append(result)
+            mode = "global lock" if global_lock else "file locks"
+            print(f"{mode:11} {threads:3} threads {result['ops']:>9} ops {result['ops_per_s']:>10.1f}/s "
+                  f"speedup {result['speedup']:5.2f}x")
+            for error in result["errors"]:
+                print("  FAILED", error)
+            failed = failed or bool(result["errors"])
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
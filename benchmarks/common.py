@@ -0,0 +1,25 @@
+"""Import setup shared by the benchmarks that need winfspy.
+
+DhackFScode is put on sys.path, and so is the stand-in for winfspy under
+benchmarks/standin when the real package cannot be imported, e.g. on Linux.
+"""
+import os
+import sys
+
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+CODE = os.path.join(BENCHMARKS, "..", "DhackFScode")
+STANDIN = os.path.join(BENCHMARKS, "standin")
+
+
+def setup_path():
+    """Returns True when the stand-in is used instead of winfspy"""
+    sys.path.insert(0, CODE)
+    try:
+        import winfspy  # noqa: F401
+    except (ImportError, OSError):
+        # OSError: winfspy installed without the WinFsp DLL
+        sys.path.insert(0, STANDIN)
+        sys.modules.pop("winfspy", None)
+        return True
+    return False
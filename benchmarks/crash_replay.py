@@ -0,0 +1,231 @@
+"""Crash injection: kill a mounted volume at random and check what the journal replays.
+
+A child process mounts a persistent volume and applies a seeded sequence of
+creates, writes, renames, deletes and resizes, through the operazioni
+callbacks, with a checkpoint every few milliseconds. It prints a line after
+every operation returns: the operation is acknowledged and must survive. The
+parent kills it with SIGKILL (TerminateProcess on Windows) at a random time,
+mounts the volume again and compares it with a model of the sequence: it
+must hold exactly the acknowledged operations, plus possibly the one that
+was running when the child died. The next round carries on from there on the
+same volume, so crashes also hit the mount of a replayed volume.
+
+    python benchmarks/crash_replay.py --rounds 50 --seed 3
+"""
+import argparse
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_operazioni import MOUNTPOINT, STANDIN, Volume
+
+from winfspy import FILE_ATTRIBUTE
+
+import journal_fs
+import persistence
+
+
+MAX_WRITE = 150 * 1024
+MAX_SIZE = 256 * 1024
+
+
+class Model:
+    """Expected state of the volume: {path: bytearray, or None for a folder}.
+
+    step() draws the next operation from the seed and applies it, the child
+    and the parent draw the same sequence.
+    """
+
+    def __init__(self, seed):
+        self.rnd = random.Random(seed)
+        self.entries = {"\\": None}
+        self.steps = 0
+
+    def _folders(self):
+        return [path for path, data in self.entries.items() if data is None]
+
+    def _files(self):
+        return [path for path, data in self.entries.items() if data is not None]
+
+    def _child(self, folder, name):
+        return folder.rstrip("\\") + "\\" + name
+
+    def step(self):
+        rnd = self.rnd
+        self.steps += 1
+        number = self.steps
+        files = self._files()
+        others = [path for path in self.entries if path != "\\"]
+        choice = rnd.random()
+        if choice < 0.2 or not others:
+            folder = rnd.random() < 0.3
+            path = self._child(rnd.choice(self._folders()), f"{'d' if folder else 'f'}{number}")
+            self.entries[path] = None if folder else bytearray()
+            return ("create", path, folder)
+        if choice < 0.6 and files:
+            path = rnd.choice(files)
+            data = self.entries[path]
+            offset = rnd.randrange(min(len(data), MAX_SIZE) + 4096)
+            buffer = rnd.randbytes(rnd.randint(1, MAX_WRITE))
+            if offset > len(data):
+                data.extend(bytes(offset - len(data)))
+            data[offset : offset + len(buffer)] = buffer
+            return ("write", path, buffer, offset)
+        if choice < 0.7 and files:
+            path = rnd.choice(files)
+            size = rnd.randrange(MAX_SIZE)
+            data = self.entries[path]
+            del data[size:]
+            data.extend(bytes(size - len(data)))
+            return ("set_file_size", path, size)
+        if choice < 0.85:
+            path = rnd.choice(others)
+            parents = [folder for folder in self._folders() if folder != path and not folder.startswith(path + "\\")]
+            new_path = self._child(rnd.choice(parents), f"r{number}")
+            for old in [old for old in self.entries if old == path or old.startswith(path + "\\")]:
+                self.entries[new_path + old[len(path):]] = self.entries.pop(old)
+            return ("rename", path, new_path)
+        empty = [path for path in others if not any(other.startswith(path + "\\") for other in self.entries)]
+        path = rnd.choice(empty)
+        del self.entries[path]
+        return ("delete", path)
+
+
+def apply(volume, operation):
+    ops = volume.ops
+    name, path, *args = operation
+    if name == "create":
+        ops.close(volume.create(path, folder=args[0]))
+    elif name == "delete":
+        volume.delete(path)
+    else:
+        context = volume.open(path)
+        if name == "write":
+            buffer, offset = args
+            ops.write(context, buffer, offset, False, False)
+        elif name == "set_file_size":
+            ops.set_file_size(context, args[0], False)
+        else:
+            ops.rename(context, path, args[0], False)
+        ops.close(context)
+
+
+def state(volume, folder="\\", out=None):
+    """{path: contents, or None for a folder} read back through the callbacks"""
+    ops = volume.ops
+    out = {} if out is None else out
+    out[folder] = None
+    context = volume.open(folder)
+    entries = [entry for entry in ops.read_directory(context, None) if entry["file_name"] not in (".", "..")]
+    ops.close(context)
+    for entry in entries:
+        path = folder.rstrip("\\") + "\\" + entry["file_name"]
+        if entry["file_attributes"] & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY:
+            state(volume, path, out)
+        else:
+            context = volume.open(path)
+            size = entry["file_size"]
+            out[path] = bytes(ops.read(context, 0, size)) if size else b""
+            ops.close(context)
+    return out
+
+
+def child(directory, seed, start, count, interval):
+    volume = Volume(directory)
+    ops = volume.ops
+    checkpointer = journal_fs.Checkpointer(
+        ops.journal, lambda: persistence.checkpoint(ops, MOUNTPOINT, directory), interval=interval, poll=interval
+    )
+    checkpointer.start()
+    model = Model(seed)
+    for _ in range(start):
+        model.step()
+    print("mounted", flush=True)
+    for _ in range(count):
+        apply(volume, model.step())
+        print("ack", flush=True)
+
+
+def run_child(args, directory, start, kill_after, in_mount):
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--child", directory, "--seed", str(args.seed), "--start", str(start),
+         "--ops", str(args.ops), "--interval", str(args.interval)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    lines = []
+    mounted = threading.Event()
+
+    def read():
+        for line in process.stdout:
+            lines.append(line.strip())
+            mounted.set()
+        # the child died on its own
+        mounted.set()
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    # counted from the start when the mount, which replays and checkpoints,
+    # is what gets killed, from the end of the mount otherwise
+    if not in_mount:
+        mounted.wait()
+    time.sleep(kill_after)
+    process.kill()
+    process.wait()
+    reader.join()
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ops", type=int, default=100000, help="operations a child runs at most")
+    parser.add_argument("--kill-after", type=float, nargs=2, default=[0.05, 1.0], metavar=("MIN", "MAX"),
+                        help="seconds after which the child is killed, drawn at random")
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between checkpoints in the child")
+    parser.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--start", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.seed, args.start, args.ops, args.interval)
+        return
+
+    if STANDIN:
+        print("winfspy not available, using benchmarks/standin")
+    rnd = random.Random(args.seed)
+    model = Model(args.seed)
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        Volume(directory).crash()
+        for number in range(args.rounds):
+            lines = run_child(args, directory, model.steps, rnd.uniform(*args.kill_after), rnd.random() < 0.2)
+            acked = lines.count("ack")
+            for _ in range(acked):
+                model.step()
+            volume = Volume(directory)
+            found = state(volume)
+            expected = {path: None if data is None else bytes(data) for path, data in model.entries.items()}
+            in_flight = ""
+            if found != expected and "mounted" in lines and acked < args.ops:
+                # killed after the operation reached the journal, before its ack
+                model.step()
+                expected = {path: None if data is None else bytes(data) for path, data in model.entries.items()}
+                in_flight = " + 1 in flight"
+            volume.crash()
+            if found != expected:
+                differ = sorted(set(found) ^ set(expected)) or [path for path in expected if found[path] != expected[path]]
+                print(f"round {number:3}: FAILED after {model.steps} operations, first difference at {differ[0]}")
+                failed = True
+                break
+            print(f"round {number:3}: {acked:5} acknowledged{in_flight}, {model.steps:6} operations, "
+                  f"{len(expected):4} entries")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
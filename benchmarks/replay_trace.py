@@ -0,0 +1,46 @@
+"""Replay an operation trace on a fresh volume, see trace_fs.
+
+A trace is recorded with `dhack_main.py --trace-file FILE`. The replay runs
+on a new persistent volume in a temporary key store: entries the trace
+found on the volume are created first, data is replaced by zeros. The same
+trace replayed on two versions of the code gives identical input to both.
+
+    python benchmarks/replay_trace.py trace.bin
+    python benchmarks/replay_trace.py trace.bin --concurrent --speed 2 --json replay.json
+"""
+import argparse
+import json
+import tempfile
+
+from bench_operazioni import Volume
+
+import trace_fs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="one thread per traced thread, operations started at their traced times")
+    parser.add_argument("--speed", type=float, default=1.0, help="with --concurrent, replay this many times faster")
+    parser.add_argument("--json", type=str, default=None, help="write the outcome and the metrics to this file")
+    args = parser.parse_args()
+
+    _, records = trace_fs.read_trace(args.trace)
+    with tempfile.TemporaryDirectory() as directory:
+        volume = Volume(directory)
+        outcome = trace_fs.replay(volume.ops, records, args.concurrent, args.speed)
+        metrics = volume.ops.metrics
+        volume.unmount()
+
+    print(f"{outcome['ops']} operations in {outcome['seconds']:.3f}s (traced {outcome['traced_seconds']:.3f}s), "
+          f"{outcome['errors']} errors, {outcome['mismatches']} differing from the trace, "
+          f"{outcome['skipped']} not replayed")
+    print(metrics.report())
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({**outcome, "metrics": metrics.snapshot()}, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
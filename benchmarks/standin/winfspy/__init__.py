@@ -0,0 +1,58 @@
+"""Stand-in for the parts of winfspy DhackFScode uses, for benchmarks on
+machines without WinFsp. Only the types and constants: nothing is mounted,
+the benchmarks call the operazioni callbacks directly."""
+import enum
+
+
+class NTStatusError(Exception):
+    value = 0xC0000001
+
+
+class NTStatusObjectNameNotFound(NTStatusError):
+    value = 0xC0000034
+
+
+class NTStatusObjectNameCollision(NTStatusError):
+    value = 0xC0000035
+
+
+class NTStatusAccessDenied(NTStatusError):
+    value = 0xC0000022
+
+
+class NTStatusDirectoryNotEmpty(NTStatusError):
+    value = 0xC0000101
+
+
+class NTStatusNotADirectory(NTStatusError):
+    value = 0xC0000103
+
+
+class NTStatusMediaWriteProtected(NTStatusError):
+    value = 0xC00000A2
+
+
+class NTStatusEndOfFile(NTStatusError):
+    value = 0xC0000011
+
+
+class FILE_ATTRIBUTE(enum.IntFlag):
+    FILE_ATTRIBUTE_READONLY = 0x1
+    FILE_ATTRIBUTE_HIDDEN = 0x2
+    FILE_ATTRIBUTE_SYSTEM = 0x4
+    FILE_ATTRIBUTE_DIRECTORY = 0x10
+    FILE_ATTRIBUTE_ARCHIVE = 0x20
+    FILE_ATTRIBUTE_NORMAL = 0x80
+    INVALID_FILE_ATTRIBUTES = 0xFFFFFFFF
+
+
+class CREATE_FILE_CREATE_OPTIONS(enum.IntFlag):
+    FILE_DIRECTORY_FILE = 0x1
+    FILE_WRITE_THROUGH = 0x2
+    FILE_SEQUENTIAL_ONLY = 0x4
+    FILE_NON_DIRECTORY_FILE = 0x40
+    FILE_DELETE_ON_CLOSE = 0x1000
+
+
+class BaseFileSystemOperations:
+    pass
@@ -0,0 +1,37 @@
+import enum
+
+
+class NTSTATUS(enum.IntEnum):
+    STATUS_SUCCESS = 0x0
+    STATUS_UNEXPECTED_IO_ERROR = 0xC00000E9
+
+
+class WinFSPyError(Exception):
+    pass
+
+
+class FileSystemAlreadyStarted(WinFSPyError):
+    pass
+
+
+class FileSystemNotStarted(WinFSPyError):
+    pass
+
+
+class _FFI:
+    """Only ffi.buffer, over the bytes the stand-in descriptors use as handle"""
+
+    def buffer(self, handle, size):
+        return memoryview(handle)[:size]
+
+
+ffi = _FFI()
+lib = None
+
+
+def nt_success(status):
+    return status >= 0
+
+
+def cook_ntstatus(status):
+    return status
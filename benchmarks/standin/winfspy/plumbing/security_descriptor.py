@@ -0,0 +1,18 @@
+class SecurityDescriptor:
+    """A descriptor held as its SDDL string, the bytes of which stand for the handle"""
+
+    def __init__(self, string_format):
+        self._string_format = string_format
+        self.handle = string_format.encode("utf-8")
+        self.size = len(self.handle)
+
+    @classmethod
+    def from_string(cls, string_format):
+        return cls(string_format)
+
+    def to_string(self):
+        return self._string_format
+
+    def evolve(self, security_information, modification_descriptor):
+        # no ACL merging, enough for a new descriptor to differ from the old one
+        return type(self)(f"{self._string_format}|{security_information:x}:{modification_descriptor!r}")
@@ -0,0 +1,9 @@
+import time
+
+
+# FILETIME counts 100ns intervals since 1601-01-01
+_EPOCH_AS_FILETIME = 116444736000000000
+
+
+def filetime_now():
+    return _EPOCH_AS_FILETIME + time.time_ns() // 100